@@ -0,0 +1,283 @@
+"""
+Benchmark the Wikipedia datasources end to end
+
+Starts a local mock Wikipedia API (see `mock_api.py`), then collects a
+dataset with each datasource against it and reports the number of requests
+per second, wall time, peak memory use (RSS) and bytes transferred per
+scenario. Each scenario runs in its own process, so memory use is measured
+for that scenario alone.
+
+Datasources are run outside of a 4CAT job, with a minimal stand-in for the
+dataset they collect. The API can be made slow or unreliable with the
+`--latency`, `--jitter` and `--error-rate` options.
+
+Run from the 4CAT root folder, e.g.:
+
+    python -m extensions.wikitools.benchmarks.datasources --pages 4 --revisions 2000
+"""
+
+import subprocess
+import argparse
+import resource
+import tempfile
+import json
+import time
+import sys
+
+from pathlib import Path
+
+from extensions.wikitools.benchmarks.mock_api import MockWikipediaAPI, SyntheticWiki
+
+scenarios = {
+    "revisions": "Revisions, via SearchWikiRevisions",
+    "toc-parse": "TOCs, parsing each revision",
+    "toc-wikitext": "TOCs, extracted from wikitext",
+    "images": "Images, via SearchWikiImages",
+}
+
+
+class BenchmarkDataset:
+    """
+    Stand-in for the dataset a datasource collects
+    """
+
+    def __init__(self, results_path):
+        """
+        Set up dataset
+
+        :param Path results_path:  Path to the result file
+        """
+        self.results_path = results_path
+        self.num_rows = 0
+
+    def get_results_path(self):
+        """
+        Get path to the result file
+
+        :return Path:  Path
+        """
+        return self.results_path
+
+    def update_status(self, status, is_final=False):
+        """
+        Ignore status updates
+        """
+        pass
+
+    def update_progress(self, progress):
+        """
+        Ignore progress updates
+        """
+        pass
+
+    def log(self, message):
+        """
+        Ignore log messages
+        """
+        pass
+
+    def finish(self, num_rows=0):
+        """
+        Record the number of items collected
+
+        :param int num_rows:  Number of items
+        """
+        self.num_rows = num_rows
+
+
+class BenchmarkConfig(dict):
+    """
+    Stand-in for 4CAT settings
+    """
+
+    def get(self, key, default=None, **kwargs):
+        """
+        Get setting
+
+        :param str key:  Setting name
+        :param default:  Value to return if the setting is not set
+        :return:  Setting value
+        """
+        return super().get(key, default)
+
+
+def run_scenario(scenario, api_url, urls, rvlimit, workers):
+    """
+    Collect a dataset with a datasource
+
+    :param str scenario:  Scenario to run; see `scenarios`
+    :param str api_url:  URL of the mock API
+    :param list urls:  Article URLs to collect data for
+    :param int rvlimit:  Number of revisions to collect per article
+    :param int workers:  Number of parallel workers to use
+    :return dict:  Number of items collected and wall time, in seconds
+    """
+    # imported here, so only scenario processes need a full 4CAT environment
+    from extensions.wikitools.datasources.wikipedia_edits.search_wikirevs import (
+        SearchWikiRevisions,
+    )
+    from extensions.wikitools.datasources.wikipedia_toc.search_wikitoc import (
+        SearchWikiToc,
+    )
+    from extensions.wikitools.datasources.wikipedia_images.search_wikimages import (
+        SearchWikiImages,
+    )
+
+    datasource, parameters = {
+        "revisions": (SearchWikiRevisions, {"rvlimit": rvlimit, "geolocate": False}),
+        "toc-parse": (SearchWikiToc, {"rvlimit": rvlimit, "extraction": "parse"}),
+        "toc-wikitext": (SearchWikiToc, {"rvlimit": rvlimit, "extraction": "wikitext"}),
+        "images": (SearchWikiImages, {}),
+    }[scenario]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # the datasource is not run as part of a 4CAT job, so set up the
+        # attributes the job would otherwise set up
+        processor = datasource.__new__(datasource)
+        processor.dataset = BenchmarkDataset(
+            Path(temp_dir).joinpath(f"benchmark.{datasource.extension}")
+        )
+        processor.parameters = {"urls": "\n".join(urls), **parameters}
+        processor.interrupted = False
+        processor.config = BenchmarkConfig(
+            {
+                "api.wikipedia": "",
+                "wikitools.api_url_override": api_url,
+                "wikitools.rate_limit_anonymous": 100000,
+                "wikitools.max_connections_per_host": workers,
+                "wikitools.pagename_ttl": 0,
+                "wikitools.cache_enabled": False,
+                f"{datasource.type}.max_workers": workers,
+            }
+        )
+
+        started = time.monotonic()
+        try:
+            if scenario == "revisions":
+                # write items as 4CAT would, so that is included in the timing
+                num_items = 0
+                with processor.dataset.get_results_path().open("w") as outfile:
+                    for item in processor.get_items(processor.parameters):
+                        outfile.write(json.dumps(item) + "\n")
+                        num_items += 1
+            else:
+                processor.process()
+                num_items = processor.dataset.num_rows
+        finally:
+            processor.clean_up()
+
+        return {"items": num_items, "wall_time": time.monotonic() - started}
+
+
+def run_in_process(scenario, api, args):
+    """
+    Run a scenario in a separate process
+
+    :param str scenario:  Scenario to run; see `scenarios`
+    :param MockWikipediaAPI api:  Mock API to run the scenario against
+    :param argparse.Namespace args:  Command line arguments
+    :return dict:  Scenario results
+    """
+    api.reset_stats()
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "extensions.wikitools.benchmarks.datasources",
+            "--run",
+            scenario,
+            "--api-url",
+            api.url,
+            "--pages",
+            str(args.pages),
+            "--revisions",
+            str(args.revisions),
+            "--workers",
+            str(args.workers),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Scenario {scenario} failed:\n{result.stderr}")
+
+    return {**json.loads(result.stdout.strip().split("\n")[-1]), **api.stats}
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    cli.add_argument(
+        "--scenario",
+        nargs="+",
+        choices=list(scenarios),
+        default=list(scenarios),
+        help="Scenarios to run (default: all): "
+        + ", ".join([f"{name} ({description})" for name, description in scenarios.items()]),
+    )
+    cli.add_argument("--pages", type=int, default=2, help="Articles to collect data for")
+    cli.add_argument("--revisions", type=int, default=1000, help="Revisions per article")
+    cli.add_argument("--workers", type=int, default=4, help="Parallel workers")
+    cli.add_argument("--languages", type=int, default=10, help="Language versions per article")
+    cli.add_argument("--images", type=int, default=40, help="Images per article")
+    cli.add_argument("--latency", type=float, default=50, help="Mean API response time, in ms")
+    cli.add_argument("--jitter", type=float, default=20, help="API response time deviation, in ms")
+    cli.add_argument(
+        "--error-rate", type=float, default=0, help="Fraction of API requests that fail"
+    )
+    cli.add_argument("--json", type=Path, help="Also write results to this JSON file")
+
+    # used internally, to run a single scenario in its own process
+    cli.add_argument("--run", choices=list(scenarios), help=argparse.SUPPRESS)
+    cli.add_argument("--api-url", help=argparse.SUPPRESS)
+    args = cli.parse_args()
+
+    urls = [
+        f"https://en.wikipedia.org/wiki/Benchmark_article_{i + 1}" for i in range(args.pages)
+    ]
+
+    if args.run:
+        result = run_scenario(args.run, args.api_url, urls, args.revisions, args.workers)
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result["peak_rss"] = peak_rss if sys.platform == "darwin" else peak_rss * 1024
+        print(json.dumps(result))
+        sys.exit(0)
+
+    api = MockWikipediaAPI(
+        wiki=SyntheticWiki(
+            revisions=args.revisions, languages=args.languages, images=args.images
+        ),
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+    )
+    api.start()
+
+    print(
+        f"{args.pages:,} article(s), {args.revisions:,} revisions each, {args.workers} workers, "
+        f"{args.latency:.0f}±{args.jitter:.0f} ms latency, {args.error_rate:.1%} errors\n"
+    )
+    print(
+        f"{'Scenario':<16}{'Items':>9}{'Requests':>10}{'Req/s':>9}{'Wall time':>11}"
+        f"{'Peak RSS':>11}{'Transferred':>13}"
+    )
+
+    results = {}
+    for scenario in args.scenario:
+        result = run_in_process(scenario, api, args)
+        results[scenario] = result
+        print(
+            f"{scenario:<16}{result['items']:>9,}{result['requests']:>10,}"
+            f"{result['requests'] / result['wall_time']:>9,.1f}{result['wall_time']:>10,.2f}s"
+            f"{result['peak_rss'] / 1024 / 1024:>8,.1f} MB{result['bytes'] / 1024 / 1024:>10,.2f} MB"
+        )
+
+    api.shutdown()
+    if args.json:
+        arguments = {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("json", "run", "api_url")
+        }
+        with args.json.open("w") as outfile:
+            json.dump({"arguments": arguments, "results": results}, outfile, indent=2)
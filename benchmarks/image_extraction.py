@@ -0,0 +1,218 @@
+"""
+Benchmark extraction of images from parsed Wikipedia articles
+
+Extracts image sources from recorded `action=parse` output with the
+streaming extractor used by the image scraper, and with the BeautifulSoup
+tree it replaced, checks that both return the same images in the same order
+and reports the time taken and peak memory use of both.
+
+Fixtures are stored as HTML files in `benchmarks/fixtures`. Record them for
+an article and all its language versions with e.g.:
+
+    python -m extensions.wikitools.benchmarks.image_extraction --record https://en.wikipedia.org/wiki/Emoji
+
+Fixtures are not included with the extension. Without any recorded
+fixtures (or with `--synthetic`), synthetic articles are generated instead:
+one long article with some unusual markup, and a number of articles as
+served by the mock API in `mock_api.py`. Run from the 4CAT root folder:
+
+    python -m extensions.wikitools.benchmarks.image_extraction
+"""
+
+import tracemalloc
+import argparse
+import requests
+import random
+import time
+
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+from bs4 import BeautifulSoup
+
+from extensions.wikitools.benchmarks.mock_api import SyntheticWiki
+from extensions.wikitools.wikipedia_html import iter_image_sources
+from extensions.wikitools.wikipedia_transport import WikipediaTransport
+
+fixtures_folder = Path(__file__).parent.joinpath("fixtures")
+
+
+def record_fixtures(url, max_languages):
+    """
+    Record parsed HTML for all language versions of an article
+
+    :param str url:  Article URL
+    :param int max_languages:  Maximum number of language versions to record
+    """
+    language = urlparse(url).hostname.split(".")[0]
+    page = unquote(urlparse(url).path.split("/wiki/")[-1])
+    headers = {"User-Agent": WikipediaTransport.user_agent}
+
+    languages = requests.get(
+        f"https://api.wikimedia.org/core/v1/wikipedia/{language}/page/{page}/links/language",
+        headers=headers,
+    ).json()
+    languages.insert(0, {"title": page, "code": language})
+
+    fixtures_folder.mkdir(exist_ok=True)
+    for language_version in languages[:max_languages]:
+        parsed = requests.get(
+            f"https://{language_version['code']}.wikipedia.org/w/api.php",
+            headers=headers,
+            params={
+                "action": "parse",
+                "page": language_version["title"],
+                "format": "json",
+                "prop": "text",
+                "disablelimitreport": "1",
+                "disableeditsection": "1",
+            },
+        ).json()
+        if "parse" not in parsed:
+            continue
+
+        fixture = fixtures_folder.joinpath(
+            f"{language_version['code']}-{language_version['title'].replace('/', '_')}.html"
+        )
+        fixture.write_text(parsed["parse"]["text"]["*"])
+        print(f"Recorded {fixture.name}")
+
+
+def generate_article(num_paragraphs=2000, seed=0):
+    """
+    Generate HTML resembling a long parsed Wikipedia article
+
+    :param int num_paragraphs:  Number of paragraphs
+    :param int seed:  Random seed
+    :return str:  HTML
+    """
+    rng = random.Random(seed)
+    html = ['<div class="mw-content-ltr mw-parser-output" lang="en" dir="ltr">']
+    html.append('<table class="infobox"><tbody><tr><td><span typeof="mw:File">')
+    html.append(
+        '<img src="//upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Infobox.svg/220px-Infobox.svg.png" '
+        'decoding="async" width="220" height="220" class="mw-file-element" /></span></td></tr></tbody></table>'
+    )
+    for i in range(num_paragraphs):
+        if i % 25 == 0:
+            html.append(f'<h2 id="Section_{i}">Section {i}</h2>')
+        if rng.random() < 0.05:
+            name = f"Image_{rng.randint(0, 500)}.jpg"
+            html.append(
+                f'<figure typeof="mw:File/Thumb"><a href="/wiki/File:{name}" class="mw-file-description">'
+                f'<img src="//upload.wikimedia.org/wikipedia/commons/thumb/1/1a/{name}/250px-{name}" '
+                f'decoding="async" width="250" height="188" class="mw-file-element" '
+                f'srcset="//upload.wikimedia.org/wikipedia/commons/thumb/1/1a/{name}/500px-{name} 2x"></a>'
+                f"<figcaption>Caption with <i>markup</i> &amp; an entity</figcaption></figure>"
+            )
+        html.append(
+            f"<p>Paragraph {i} with <a href=\"/wiki/Link_{i}\" title=\"Link {i}\">a link</a>, "
+            f"<b>bold text</b>, a reference<sup id=\"cite_ref-{i}\" class=\"reference\">"
+            f"<a href=\"#cite_note-{i}\">[{i}]</a></sup> and some more text to pad it out.</p>"
+        )
+        if rng.random() < 0.01:
+            html.append(f"<!-- <img src=\"//example.com/commented/out/{i}.png\"> -->")
+
+    html.append("</div>")
+    return "\n".join(html)
+
+
+def generate_fixtures(num_articles=20, seed=0):
+    """
+    Generate synthetic fixtures
+
+    :param int num_articles:  Number of articles to generate in addition to
+    the long article from `generate_article()`
+    :param int seed:  Random seed
+    :return dict:  HTML, with fixture names as keys
+    """
+    wiki = SyntheticWiki(images=60, image_pool=500, content_size=100000)
+    fixtures = {"synthetic-long.html": generate_article(seed=seed)}
+    for i in range(num_articles):
+        page_id = wiki.get_page_id("en", f"Synthetic article {seed}-{i}")
+        fixtures[f"synthetic-{i}.html"] = wiki.get_article_html("en", page_id)
+
+    return fixtures
+
+
+def get_images_beautifulsoup(html):
+    """
+    Get image sources by building a BeautifulSoup tree
+
+    :param str html:  HTML
+    :return list:  Image sources
+    """
+    dom = BeautifulSoup(html, "html.parser")
+    return [image["src"] for image in dom.find_all("img")]
+
+
+def get_images_streaming(html):
+    """
+    Get image sources with the streaming extractor
+
+    :param str html:  HTML
+    :return list:  Image sources
+    """
+    return list(iter_image_sources(html))
+
+
+def measure(extractor, fixtures):
+    """
+    Extract images from all fixtures
+
+    :param callable extractor:  Function to extract images with
+    :param dict fixtures:  HTML, with fixture names as keys
+    :return tuple:  Images per fixture, time taken in seconds, and peak
+    memory use in bytes
+    """
+    start = time.perf_counter()
+    images = {name: extractor(html) for name, html in fixtures.items()}
+    elapsed = time.perf_counter() - start
+
+    # measure memory separately, since tracing slows things down
+    tracemalloc.start()
+    for html in fixtures.values():
+        extractor(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return images, elapsed, peak
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    cli.add_argument("--record", help="Record fixtures for this article URL and its language versions")
+    cli.add_argument("--max-languages", type=int, default=300, help="Maximum number of language versions to record")
+    cli.add_argument("--synthetic", action="store_true", help="Use synthetic articles, even if fixtures were recorded")
+    cli.add_argument("--articles", type=int, default=20, help="Number of synthetic articles to generate")
+    args = cli.parse_args()
+
+    if args.record:
+        record_fixtures(args.record, args.max_languages)
+        return
+
+    fixtures = {}
+    if not args.synthetic:
+        fixtures = {fixture.name: fixture.read_text() for fixture in sorted(fixtures_folder.glob("*.html"))}
+
+    if not fixtures:
+        print("Using synthetic articles")
+        fixtures = generate_fixtures(args.articles)
+
+    size = sum([len(html) for html in fixtures.values()])
+    print(f"{len(fixtures):,} fixture(s), {size / 1024 / 1024:,.1f} MB of HTML")
+
+    expected, bs_time, bs_peak = measure(get_images_beautifulsoup, fixtures)
+    actual, stream_time, stream_peak = measure(get_images_streaming, fixtures)
+
+    for name in fixtures:
+        if expected[name] != actual[name]:
+            raise SystemExit(f"Images differ for fixture {name}")
+
+    print(f"{sum([len(images) for images in actual.values()]):,} images found, identical for both methods")
+    print(f"BeautifulSoup: {bs_time:.3f}s, peak memory {bs_peak / 1024 / 1024:,.1f} MB")
+    print(f"Streaming:     {stream_time:.3f}s, peak memory {stream_peak / 1024 / 1024:,.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
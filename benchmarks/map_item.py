@@ -0,0 +1,179 @@
+"""
+Benchmark mapping of collected Wikipedia revisions
+
+Generates a synthetic ndjson file with revisions as collected by the
+revisions scraper, then maps every item with `SearchWikiRevisions.map_item`
+and reports the number of items mapped per second. The previous
+implementation (based on `strptime()` and regular expressions) is timed as
+well for comparison, and the output of both is checked to be identical.
+
+Run from the 4CAT root folder, e.g.:
+
+    python -m extensions.wikitools.benchmarks.map_item --items 1000000
+"""
+
+import argparse
+import datetime
+import tempfile
+import random
+import json
+import time
+import re
+
+from pathlib import Path
+
+from extensions.wikitools.datasources.wikipedia_edits.search_wikirevs import (
+    SearchWikiRevisions,
+)
+from common.lib.item_mapping import MappedItem
+
+
+def reference_map_item(item):
+    """
+    Map collected item, as done before optimisation
+
+    :param item:  Item collected
+    :return MappedItem:  Item mapped for display in CSV files, etc
+    """
+    timestamp = datetime.datetime.strptime(item["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+
+    section = ""
+    if re.match(r"/\* ([^*]+) \*/", item.get("comment", "")):
+        section = re.findall(r"/\* (.*) \*/", item["comment"])[0]
+
+    return MappedItem(
+        {
+            "id": item["revid"],
+            "thread_id": item.get("parentid"),
+            "page": item["title"],
+            "language": item["language"],
+            "url": f"https://{item['language']}.wikipedia.org/w/index.php?title={item['title'].replace(' ', '_')}&oldid={item['revid']}",
+            "author": item["user"],
+            "author_anonymous_location": item.get("location", ""),
+            "is_anonymous": "yes" if "anon" in item else "no",
+            "is_minor_edit": "yes" if "minor" in item else "no",
+            "is_probably_bot": (
+                "yes" if item["user"].lower().endswith("bot") else "no"
+            ),
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            "section": section,
+            "body": item.get("comment", ""),
+            "unix_timestamp": int(timestamp.timestamp()),
+        }
+    )
+
+
+def generate_revisions(path, num_items, seed=0):
+    """
+    Write synthetic revisions to an ndjson file
+
+    :param Path path:  File to write to
+    :param int num_items:  Number of revisions to write
+    :param int seed:  Random seed
+    """
+    rng = random.Random(seed)
+    comments = [
+        "",
+        "/* History */ copyedit",
+        "/* Early life and career */ added source",
+        "Undid revision 123456 by [[Special:Contributions/Example|Example]]",
+        "/* See also */",
+        "/* a */ /* b */ two sections",
+        "/**/ not a section",
+        "/* 5 * 5 */ not a section either",
+        "Reverted edits by Example (talk) to last version by Other",
+    ]
+    start = datetime.datetime(2001, 1, 15, tzinfo=datetime.timezone.utc).timestamp()
+
+    with path.open("w") as outfile:
+        for revid in range(1, num_items + 1):
+            anonymous = rng.random() < 0.2
+            timestamp = datetime.datetime.fromtimestamp(
+                start + rng.randint(0, 700_000_000), datetime.timezone.utc
+            )
+            item = {
+                "title": rng.choice(["Emoji", "Man in Business Suit Levitating"]),
+                "language": rng.choice(["en", "nl", "de"]),
+                "location": "NL / Netherlands / North Holland / Amsterdam" if anonymous else "",
+                "revid": revid,
+                "parentid": revid - 1,
+                "user": (
+                    f"192.0.2.{rng.randint(0, 255)}"
+                    if anonymous
+                    else rng.choice(["Example", "ClueBot", "Other user"])
+                ),
+                "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "comment": rng.choice(comments),
+            }
+            if anonymous:
+                item["anon"] = ""
+            if rng.random() < 0.3:
+                item["minor"] = ""
+
+            outfile.write(json.dumps(item) + "\n")
+
+
+def benchmark(path, mapper):
+    """
+    Map all items in an ndjson file
+
+    :param Path path:  File to read items from
+    :param callable mapper:  Function to map items with, or `None` to only
+    read them
+    :return tuple:  Number of items, and time taken in seconds
+    """
+    num_items = 0
+    start = time.perf_counter()
+    with path.open() as infile:
+        for line in infile:
+            item = json.loads(line)
+            if mapper:
+                mapper(item)
+            num_items += 1
+
+    return num_items, time.perf_counter() - start
+
+
+def main():
+    cli = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    cli.add_argument("--items", type=int, default=1_000_000, help="Number of revisions to generate")
+    cli.add_argument("--file", help="Existing ndjson file to map, instead of generating one")
+    cli.add_argument("--verify", type=int, default=100_000, help="Number of items to compare output for")
+    args = cli.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        if args.file:
+            path = Path(args.file)
+        else:
+            path = Path(temp_folder).joinpath("revisions.ndjson")
+            print(f"Generating {args.items:,} revisions in {path}...")
+            generate_revisions(path, args.items)
+
+        print(f"Comparing output for the first {args.verify:,} items...")
+        with path.open() as infile:
+            for i, line in enumerate(infile):
+                if i >= args.verify:
+                    break
+
+                item = json.loads(line)
+                expected = reference_map_item(item).get_item_data()
+                actual = SearchWikiRevisions.map_item(item).get_item_data()
+                if expected != actual:
+                    raise SystemExit(f"Output differs for item {i}:\n{expected}\n{actual}")
+
+        num_items, read_time = benchmark(path, None)
+        print(f"Read only:        {num_items / read_time:>12,.0f} items/s ({read_time:.2f}s)")
+
+        for label, mapper in (
+            ("Previous mapping", reference_map_item),
+            ("Current mapping", SearchWikiRevisions.map_item),
+        ):
+            num_items, map_time = benchmark(path, mapper)
+            print(
+                f"{label}: {num_items / map_time:>12,.0f} items/s ({map_time:.2f}s, "
+                f"{num_items / max(0.001, map_time - read_time):,.0f} items/s excluding reading)"
+            )
+
+
+if __name__ == "__main__":
+    main()
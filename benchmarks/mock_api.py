@@ -0,0 +1,748 @@
+"""
+Local stand-in for the Wikipedia APIs, for benchmarking
+
+Serves synthetic, deterministic data for the API requests the Wikipedia
+datasources make:
+
+- `action=query`, for canonical page names, revision histories, revision
+  wikitext, language links and image file metadata
+- `action=parse`, for the TOC of a revision or the HTML of an article
+- the REST API's `links/language` endpoint, for language versions
+
+Every page exists and has a history of a configurable number of revisions,
+with headings that are added as the article grows. Responses can be delayed
+and a fraction of requests can be made to fail, to simulate a busy API.
+
+Requests are expected with the original host name as the first part of the
+path, e.g. `http://localhost:8080/en.wikipedia.org/w/api.php`; this is what
+the `wikitools.api_url_override` setting does. Run from the 4CAT root folder
+to start a server to point 4CAT at, e.g.:
+
+    python -m extensions.wikitools.benchmarks.mock_api --port 8080
+"""
+
+import argparse
+import datetime
+import hashlib
+import random
+import json
+import gzip
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# languages that pages are available in, in order of preference
+LANGUAGES = [
+    "en", "de", "fr", "nl", "es", "it", "pl", "pt", "sv", "ja",
+    "ru", "zh", "uk", "ar", "fa", "ca", "cs", "fi", "no", "ko",
+]  # fmt: skip
+
+FILLER = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua. "
+)
+
+# timestamp of the first revision of every page
+FIRST_REVISION = int(datetime.datetime(2005, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+
+class SyntheticWiki:
+    """
+    Deterministic synthetic Wikipedia content
+
+    Pages are identified by a page ID derived from their language and title.
+    Revision `r` (counting from 0, the oldest) of a page has revision ID
+    `page ID * 10^7 + r + 1` and was made `r` hours after the first one, so
+    revisions can be generated on demand rather than stored.
+    """
+
+    def __init__(
+        self,
+        revisions=1000,
+        languages=10,
+        images=40,
+        image_pool=200,
+        content_size=20000,
+    ):
+        """
+        Set up synthetic wiki
+
+        :param int revisions:  Number of revisions of each page
+        :param int languages:  Number of other language versions of each page
+        :param int images:  Number of images in each article
+        :param int image_pool:  Number of distinct images that articles'
+        images are picked from; the smaller, the more images articles share
+        :param int content_size:  Approximate size of article wikitext and
+        HTML, in bytes
+        """
+        self.revisions = revisions
+        self.languages = languages
+        self.images = min(images, image_pool)
+        self.image_pool = image_pool
+        self.content_size = content_size
+        self.titles = {}
+
+    def get_page_id(self, language, title):
+        """
+        Get ID of a page
+
+        :param str language:  Wikipedia language
+        :param str title:  Page title
+        :return int:  Page ID
+        """
+        page_id = zlib.crc32(f"{language}:{title}".encode("utf-8")) % 900000 + 100000
+        self.titles[page_id] = title
+        return page_id
+
+    def get_revision(self, page_id, index, rvprop):
+        """
+        Get revision metadata
+
+        :param int page_id:  Page ID
+        :param int index:  Revision number, 0 being the oldest
+        :param str rvprop:  Fields to include, as for the API
+        :return dict:  Revision metadata
+        """
+        fields = rvprop.split("|")
+        revision = {}
+        if "ids" in fields:
+            revision["revid"] = page_id * 10**7 + index + 1
+            revision["parentid"] = page_id * 10**7 + index if index else 0
+
+        if "flags" in fields and index % 5 == 0:
+            revision["minor"] = ""
+
+        if "user" in fields:
+            if index % 7 == 3:
+                revision["user"] = f"198.51.100.{(page_id + index) % 250}"
+                revision["anon"] = ""
+            elif index % 11 == 5:
+                revision["user"] = "ExampleBot"
+            else:
+                revision["user"] = f"Editor{(page_id + index * 31) % 200}"
+
+        if "timestamp" in fields:
+            revision["timestamp"] = format_timestamp(FIRST_REVISION + index * 3600)
+
+        if "comment" in fields:
+            headings = self.get_headings(page_id, index)
+            if index % 3 == 0 and headings:
+                revision["comment"] = f"/* {headings[index % len(headings)][1]} */ copyedit"
+            else:
+                revision["comment"] = "Expanded article"
+
+        return revision
+
+    def get_headings(self, page_id, index):
+        """
+        Get headings of a revision
+
+        Headings are added one by one as the page's history progresses, and
+        some are renamed at some point, so TOCs change every now and then.
+
+        :param int page_id:  Page ID
+        :param int index:  Revision number
+        :return list:  Headings, as `(level, text)` tuples
+        """
+        rng = random.Random(page_id)
+        headings = []
+        for i in range(40):
+            level = 3 if i and rng.random() < 0.3 else 2
+            added = (i * self.revisions) // 40
+            if added > index:
+                break
+
+            text = f"Section {i + 1}"
+            if (i * 7) % 5 == 0 and index - added > self.revisions // 10:
+                text += " (revised)"
+
+            headings.append((level, text))
+
+        return headings
+
+    def get_wikitext(self, page_id, index):
+        """
+        Get wikitext of a revision
+
+        :param int page_id:  Page ID
+        :param int index:  Revision number
+        :return str:  Wikitext
+        """
+        headings = self.get_headings(page_id, index)
+        paragraph = FILLER * max(1, self.content_size // len(FILLER) // (len(headings) + 1))
+        wikitext = paragraph + "\n"
+        for level, text in headings:
+            wikitext += f"{'=' * level} {text} {'=' * level}\n{paragraph}\n"
+
+        return wikitext
+
+    def get_sections(self, page_id, index):
+        """
+        Get TOC of a revision, as returned by `action=parse`
+
+        :param int page_id:  Page ID
+        :param int index:  Revision number
+        :return list:  Sections
+        """
+        sections = []
+        numbers = []
+        for level, text in self.get_headings(page_id, index):
+            toclevel = 1 if level == 2 or not numbers else 2
+            numbers = numbers[:toclevel]
+            numbers += [0] * (toclevel - len(numbers))
+            numbers[-1] += 1
+            sections.append(
+                {
+                    "toclevel": toclevel,
+                    "level": str(level),
+                    "line": text,
+                    "number": ".".join([str(n) for n in numbers]),
+                    "index": str(len(sections) + 1),
+                    "fromtitle": self.titles.get(page_id, ""),
+                    "byteoffset": None,
+                    "anchor": text.replace(" ", "_"),
+                    "linkanchor": text.replace(" ", "_"),
+                }
+            )
+
+        return sections
+
+    def get_image_file(self, language, image):
+        """
+        Get repository and file name of an image
+
+        Most images are on Wikimedia Commons, but some are local copies,
+        uploaded to the Wikipedia of the article's language.
+
+        :param str language:  Wikipedia language of the article
+        :param int image:  Image number
+        :return tuple:  Repository and file name
+        """
+        repository = language if image % 10 == 0 else "commons"
+        return repository, f"Example_image_{image:05d}.jpg"
+
+    def get_image_info(self, repository, name):
+        """
+        Get file metadata, as returned by `prop=imageinfo`
+
+        Local copies have the same content, and thus hash, as the file on
+        Commons.
+
+        :param str repository:  Repository the file was uploaded to
+        :param str name:  File name, with underscores
+        :return dict:  File metadata
+        """
+        digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+        image = int(name.split("_")[-1].split(".")[0])
+        path = f"wikipedia/{repository}/{digest[0]}/{digest[:2]}/{name}"
+        host = (
+            "commons.wikimedia.org"
+            if repository == "commons"
+            else f"{repository}.wikipedia.org"
+        )
+        return {
+            "size": 100000 + image * 37,
+            "width": 800 + image % 400,
+            "height": 600 + image % 300,
+            "sha1": hashlib.sha1(name.encode("utf-8")).hexdigest(),
+            "url": f"https://upload.wikimedia.org/{path}",
+            "descriptionurl": f"https://{host}/wiki/File:{name}",
+            "descriptionshorturl": f"https://{host}/w/index.php?curid={image}",
+        }
+
+    def get_article_html(self, language, page_id):
+        """
+        Get HTML of an article, as returned by `action=parse`
+
+        :param str language:  Wikipedia language
+        :param int page_id:  Page ID
+        :return str:  HTML
+        """
+        rng = random.Random(page_id)
+        images = rng.sample(range(self.image_pool), self.images)
+        paragraph = FILLER * max(1, self.content_size // len(FILLER) // (len(images) + 1))
+
+        html = f'<div class="mw-parser-output"><p>{paragraph}</p>'
+        for image in images:
+            repository, name = self.get_image_file(language, image)
+            digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+            thumbnail = f"//upload.wikimedia.org/wikipedia/{repository}/thumb/{digest[0]}/{digest[:2]}/{name}/220px-{name}"
+            html += (
+                f'<figure typeof="mw:File/Thumb"><a href="/wiki/File:{name}" class="mw-file-description">'
+                f'<img src="{thumbnail}" decoding="async" width="220" height="165" class="mw-file-element">'
+                f"</a><figcaption>Image {image}</figcaption></figure><p>{paragraph}</p>"
+            )
+
+        return html + "</div>"
+
+    def get_language_versions(self, language, title):
+        """
+        Get other language versions of a page
+
+        :param str language:  Wikipedia language of the page
+        :param str title:  Page title
+        :return list:  Language versions, as `(language, title)` tuples
+        """
+        return [
+            (other, title)
+            for other in LANGUAGES[: self.languages + 1]
+            if other != language
+        ][: self.languages]
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """
+    Handle requests to the mock API
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # headers and body are sent separately; without this, responses on a
+    # kept-alive connection are delayed until the client acknowledges them
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """
+        Respond to a GET request
+        """
+        server = self.server
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        host, _, path = url.path.lstrip("/").partition("/")
+        path = "/" + path
+
+        delay = random.gauss(server.latency, server.jitter) if server.jitter else server.latency
+        if delay > 0:
+            time.sleep(delay)
+
+        with server.lock:
+            fail = server.rng.random() < server.error_rate
+
+        if fail:
+            status, body = 503, b"Service temporarily unavailable"
+            content_type = "text/plain"
+        else:
+            try:
+                status, response = server.respond(host, path, params)
+            except (KeyError, ValueError) as e:
+                status, response = 400, {"error": {"code": "badrequest", "info": str(e)}}
+
+            body = json.dumps(response).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+
+        headers = {"Content-Type": content_type}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        server.count(params.get("action") or "rest", len(body), status)
+
+    def log_message(self, format, *args):
+        """
+        Do not log requests to stderr
+        """
+        pass
+
+
+class MockWikipediaAPI(ThreadingHTTPServer):
+    """
+    Mock Wikipedia API server
+
+    Each request is handled in its own thread. Use `start()` to run the
+    server in the background, and `stats` for the number of requests
+    handled and bytes sent.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, wiki=None, latency=0, jitter=0, error_rate=0, seed=0):
+        """
+        Set up server
+
+        :param int port:  Port to listen on; by default, any free port
+        :param SyntheticWiki wiki:  Content to serve
+        :param float latency:  Mean time to wait before responding, in
+        seconds
+        :param float jitter:  Standard deviation of that time, in seconds
+        :param float error_rate:  Fraction of requests to respond to with an
+        HTTP 503 error
+        :param int seed:  Random seed, for which requests fail
+        """
+        super().__init__(("127.0.0.1", port), MockAPIHandler)
+        self.wiki = wiki or SyntheticWiki()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+    @property
+    def url(self):
+        """
+        URL to send requests to
+
+        :return str:  URL
+        """
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        """
+        Start serving in a background thread
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def reset_stats(self):
+        """
+        Reset request statistics
+        """
+        with self.lock:
+            self.stats = {"requests": 0, "errors": 0, "bytes": 0, "actions": {}}
+
+    def count(self, action, size, status):
+        """
+        Update request statistics
+
+        :param str action:  API action, or `rest` for REST API requests
+        :param int size:  Size of the response body, as sent, in bytes
+        :param int status:  HTTP status code
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            self.stats["errors"] += 1 if status != 200 else 0
+            self.stats["actions"][action] = self.stats["actions"].get(action, 0) + 1
+
+    def respond(self, host, path, params):
+        """
+        Get response to a request
+
+        :param str host:  Host name the request was meant for
+        :param str path:  Path on that host
+        :param dict params:  Query parameters
+        :return tuple:  HTTP status code and response data
+        """
+        language = host.split(".")[0]
+        if path.endswith("/links/language"):
+            # e.g. /w/rest.php/v1/page/Example/links/language
+            title = unquote(path.split("/page/")[1].split("/")[0]).replace("_", " ")
+            return 200, [
+                {"code": code, "name": code, "key": title.replace(" ", "_"), "title": title}
+                for code, title in self.wiki.get_language_versions(language, title)
+            ]
+
+        if not path.endswith("/api.php"):
+            return 404, {"httpCode": 404, "httpReason": "Not Found"}
+
+        action = params.get("action")
+        if action == "parse":
+            return 200, self.respond_parse(language, params)
+
+        if action != "query":
+            raise ValueError(f"Unsupported action {action}")
+
+        prop = params.get("prop")
+        if prop == "revisions" and "revids" in params:
+            return 200, self.respond_revision_content(params)
+        elif prop == "revisions":
+            return 200, self.respond_revisions(language, params)
+        elif prop == "langlinks":
+            return 200, self.respond_langlinks(language, params)
+        elif prop == "imageinfo":
+            return 200, self.respond_imageinfo(
+                "commons" if host == "commons.wikimedia.org" else language, params
+            )
+        elif not prop:
+            return 200, self.respond_titles(language, params)
+
+        raise ValueError(f"Unsupported property {prop}")
+
+    def get_pages(self, language, params):
+        """
+        Get pages for the `titles` parameter of a query
+
+        :param str language:  Wikipedia language
+        :param dict params:  Query parameters
+        :return tuple:  List of `(page ID, title)` tuples, and a list of
+        normalisations made to the titles
+        """
+        pages = []
+        normalized = []
+        for title in params["titles"].split("|"):
+            if "_" in title:
+                normalized.append({"from": title, "to": title.replace("_", " ")})
+                title = title.replace("_", " ")
+
+            pages.append((self.wiki.get_page_id(language, title), title))
+
+        return pages, normalized
+
+    @staticmethod
+    def pages_response(pages, params, extra=None):
+        """
+        Format the pages in a query response
+
+        :param list pages:  Page data
+        :param dict params:  Query parameters, for the format version
+        :param dict extra:  Other data to include in the `query` object
+        :return dict:  Response
+        """
+        if params.get("formatversion") != "2":
+            pages = {str(page["pageid"]): page for page in pages}
+
+        return {"batchcomplete": True, "query": {**(extra or {}), "pages": pages}}
+
+    def respond_titles(self, language, params):
+        """
+        Respond to a query for page titles, e.g. to resolve redirects
+
+        :param str language:  Wikipedia language
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        pages, normalized = self.get_pages(language, params)
+        return self.pages_response(
+            [{"pageid": page_id, "ns": 0, "title": title} for page_id, title in pages],
+            params,
+            {"normalized": normalized} if normalized else None,
+        )
+
+    def respond_revisions(self, language, params):
+        """
+        Respond to a query for the revision history of a page
+
+        :param str language:  Wikipedia language
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        (page_id, title), *_ = self.get_pages(language, params)[0]
+        limit = params.get("rvlimit", "1")
+        limit = 500 if limit == "max" else min(500, int(limit))
+        newer = params.get("rvdir") == "newer"
+
+        # revision numbers within the requested time range
+        first, last = 0, self.wiki.revisions - 1
+        bounds = [
+            (parse_timestamp(params[bound]) - FIRST_REVISION) / 3600 if bound in params else None
+            for bound in ("rvstart", "rvend")
+        ]
+        earliest, latest = bounds[::-1] if not newer else bounds
+        if earliest is not None:
+            first = max(first, int(-(-earliest // 1)))
+        if latest is not None:
+            last = min(last, int(latest // 1))
+
+        if "rvcontinue" in params:
+            index = int(params["rvcontinue"].split("|")[1]) % 10**7 - 1
+            if newer:
+                first = max(first, index)
+            else:
+                last = min(last, index)
+
+        if newer:
+            indexes = range(first, min(last + 1, first + limit))
+        else:
+            indexes = range(last, max(first - 1, last - limit), -1)
+
+        rvprop = params.get("rvprop", "ids|timestamp|flags|comment|user")
+        revisions = [self.wiki.get_revision(page_id, index, rvprop) for index in indexes]
+
+        response = self.pages_response(
+            [{"pageid": page_id, "ns": 0, "title": title, "revisions": revisions}],
+            params,
+        )
+        next_index = (indexes[-1] + (1 if newer else -1)) if indexes else None
+        if next_index is not None and first <= next_index <= last:
+            response["continue"] = {
+                "rvcontinue": f"{format_timestamp(FIRST_REVISION + next_index * 3600)}|{page_id * 10**7 + next_index + 1}",
+                "continue": "||",
+            }
+            del response["batchcomplete"]
+
+        return response
+
+    def respond_revision_content(self, params):
+        """
+        Respond to a query for the content of specific revisions
+
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        pages = {}
+        for revid in params["revids"].split("|"):
+            page_id, index = divmod(int(revid) - 1, 10**7)
+            revision = self.wiki.get_revision(page_id, index, "ids")
+            if "content" in params.get("rvprop", ""):
+                revision["slots"] = {
+                    "main": {
+                        "contentmodel": "wikitext",
+                        "contentformat": "text/x-wiki",
+                        "content": self.wiki.get_wikitext(page_id, index),
+                    }
+                }
+
+            pages.setdefault(
+                page_id,
+                {
+                    "pageid": page_id,
+                    "ns": 0,
+                    "title": self.wiki.titles.get(page_id, f"Page {page_id}"),
+                    "revisions": [],
+                },
+            )["revisions"].append(revision)
+
+        return self.pages_response(list(pages.values()), params)
+
+    def respond_langlinks(self, language, params):
+        """
+        Respond to a query for language links
+
+        At most 500 links are returned per response, as the API does.
+
+        :param str language:  Wikipedia language
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        pages, normalized = self.get_pages(language, params)
+        offset = int(params.get("llcontinue", 0))
+        links = [
+            (page_id, {"lang": code, "title": title})
+            for page_id, page_title in pages
+            for code, title in self.wiki.get_language_versions(language, page_title)
+        ]
+
+        response_pages = {
+            page_id: {"pageid": page_id, "ns": 0, "title": title}
+            for page_id, title in pages
+        }
+        for page_id, link in links[offset : offset + 500]:
+            response_pages[page_id].setdefault("langlinks", []).append(link)
+
+        response = self.pages_response(
+            list(response_pages.values()),
+            params,
+            {"normalized": normalized} if normalized else None,
+        )
+        if offset + 500 < len(links):
+            response["continue"] = {"llcontinue": str(offset + 500), "continue": "||"}
+
+        return response
+
+    def respond_imageinfo(self, repository, params):
+        """
+        Respond to a query for image file metadata
+
+        :param str repository:  Repository the files are in
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        pages = []
+        for i, title in enumerate(params["titles"].split("|")):
+            name = title.split(":", 1)[1].replace(" ", "_")
+            pages.append(
+                {
+                    "pageid": i + 1,
+                    "ns": 6,
+                    "title": title,
+                    "imagerepository": "local",
+                    "imageinfo": [self.wiki.get_image_info(repository, name)],
+                }
+            )
+
+        return self.pages_response(pages, params)
+
+    def respond_parse(self, language, params):
+        """
+        Respond to a request to parse a revision or page
+
+        :param str language:  Wikipedia language
+        :param dict params:  Query parameters
+        :return dict:  Response
+        """
+        if "oldid" in params:
+            page_id, index = divmod(int(params["oldid"]) - 1, 10**7)
+            return {
+                "parse": {
+                    "title": self.wiki.titles.get(page_id, f"Page {page_id}"),
+                    "pageid": page_id,
+                    "revid": int(params["oldid"]),
+                    "sections": self.wiki.get_sections(page_id, index),
+                }
+            }
+
+        title = params["page"].replace("_", " ")
+        page_id = self.wiki.get_page_id(language, title)
+        return {
+            "parse": {
+                "title": title,
+                "pageid": page_id,
+                "text": {"*": self.wiki.get_article_html(language, page_id)},
+            }
+        }
+
+
+def format_timestamp(timestamp):
+    """
+    Format a UNIX timestamp as the API does
+
+    :param int timestamp:  UNIX timestamp
+    :return str:  Timestamp, e.g. `2005-01-01T00:00:00Z`
+    """
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse a timestamp as sent to the API
+
+    :param str timestamp:  Timestamp, e.g. `2005-01-01T00:00:00Z`
+    :return int:  UNIX timestamp
+    """
+    return int(
+        datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        .replace(tzinfo=datetime.timezone.utc)
+        .timestamp()
+    )
+
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    cli.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    cli.add_argument("--revisions", type=int, default=1000, help="Revisions per page")
+    cli.add_argument("--languages", type=int, default=10, help="Language versions per page")
+    cli.add_argument("--images", type=int, default=40, help="Images per article")
+    cli.add_argument("--image-pool", type=int, default=200, help="Number of distinct images")
+    cli.add_argument("--content-size", type=int, default=20000, help="Article size, in bytes")
+    cli.add_argument("--latency", type=float, default=50, help="Mean response time, in ms")
+    cli.add_argument("--jitter", type=float, default=20, help="Response time deviation, in ms")
+    cli.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that fail")
+    args = cli.parse_args()
+
+    api = MockWikipediaAPI(
+        args.port,
+        SyntheticWiki(
+            args.revisions, args.languages, args.images, args.image_pool, args.content_size
+        ),
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=args.error_rate,
+    )
+    print(f"Serving mock Wikipedia API at {api.url}; press Ctrl+C to stop")
+    try:
+        api.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -10,6 +10,7 @@ from geoip2.errors import GeoIP2Error
 
 from backend.lib.search import Search
 from extensions.wikitools.wikipedia_scraper import WikipediaSearch
+from extensions.wikitools.wikipedia_cache import NetworkCache
 from common.lib.helpers import UserInput
 from common.lib.item_mapping import MappedItem
 from common.lib.exceptions import (
@@ -18,6 +19,8 @@ from common.lib.exceptions import (
 )
 from pathlib import Path
 
+SECTION_COMMENT = re.compile(r"/\* (.*) \*/")
+
 
 class SearchWikiRevisions(Search, WikipediaSearch):
     """
@@ -74,7 +77,130 @@ class SearchWikiRevisions(Search, WikipediaSearch):
             "help": "Wikipedia Access Token",
             "tooltip": "API key for the Wikimedia API. With an API key, more requests can be made per minute, which "
             "will speed up Wikipedia-based data sources.",
-        }
+        },
+        "wikitools.max_connections_per_host": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Connections per host",
+            "coerce_type": int,
+            "default": 4,
+            "min": 1,
+            "tooltip": "Maximum number of simultaneous connections to a single Wikipedia API host (e.g. "
+            "en.wikipedia.org) per data source. Connections are kept open and re-used between requests.",
+        },
+        "wikitools.rate_limit_authenticated": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Request rate (with API key)",
+            "coerce_type": float,
+            "default": 20,
+            "min": 0.01,
+            "tooltip": "Maximum number of requests per second to the Wikipedia APIs when an access token is "
+            "configured. This is shared between all running Wikipedia data sources. The rate is lowered "
+            "temporarily when Wikipedia indicates that too many requests are being made.",
+        },
+        "wikitools.rate_limit_anonymous": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Request rate (without API key)",
+            "coerce_type": float,
+            "default": 5,
+            "min": 0.01,
+            "tooltip": "Maximum number of requests per second to the Wikipedia APIs when no access token is "
+            "configured. This is shared between all running Wikipedia data sources.",
+        },
+        "wikirevs-search.max_workers": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Parallel page requests",
+            "coerce_type": int,
+            "default": 4,
+            "min": 1,
+            "max": 32,
+            "tooltip": "Number of pages the Wikipedia revisions scraper collects revisions for in parallel. The "
+            "number of simultaneous connections per host is additionally capped by the 'Connections per host' "
+            "setting.",
+        },
+        "wikirevs-search.history_shards": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "History periods",
+            "coerce_type": int,
+            "default": 8,
+            "min": 1,
+            "max": 64,
+            "tooltip": "When collecting more than 5,000 revisions per page, the page's history is split into "
+            "periods of about one batch of revisions each, and up to this many periods are fetched ahead in "
+            "parallel. Set to 1 to always fetch revisions one batch after another.",
+        },
+        "wikirevs-search.geolocation_cache_size": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Geolocation cache size",
+            "coerce_type": int,
+            "default": 100000,
+            "min": 0,
+            "tooltip": "Number of IP networks to remember the geolocation of between datasets, so that addresses "
+            "in the same network do not need to be looked up again.",
+        },
+        "wikirevs-search.max_retries": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Retries per request",
+            "coerce_type": int,
+            "default": 5,
+            "min": 0,
+            "max": 20,
+            "tooltip": "How often the Wikipedia revisions scraper retries a Wikipedia API request that failed for a reason that is "
+            "likely temporary, such as a server error or time-out. Retries are spaced out exponentially.",
+        },
+        "wikitools.cache_enabled": {
+            "type": UserInput.OPTION_TOGGLE,
+            "help": "Cache revision data",
+            "default": False,
+            "tooltip": "Store API responses for specific revisions (which never change) in a database in the "
+            "extension folder, so they do not need to be fetched again when the same revisions are requested "
+            "later.",
+        },
+        "wikitools.cache_size": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Cache size (MB)",
+            "coerce_type": int,
+            "default": 1024,
+            "min": 1,
+            "tooltip": "Maximum size of the revision data cache. If the cache grows larger, the least recently "
+            "used data is removed.",
+        },
+        "wikitools.api_url_override": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "API URL override",
+            "default": "",
+            "tooltip": "For testing: send all Wikipedia API requests to this URL instead, e.g. the mock API in the "
+            "extension's 'benchmarks' folder. Leave empty to use the actual Wikipedia APIs.",
+        },
+        "wikitools.transport_mode": {
+            "type": UserInput.OPTION_CHOICE,
+            "help": "API traffic",
+            "options": {
+                "live": "Send requests to Wikipedia",
+                "record": "Send requests to Wikipedia and record them",
+                "replay": "Replay recorded requests (no network access)",
+            },
+            "default": "live",
+            "tooltip": "When recording, all Wikipedia API requests and responses of a dataset are stored in a "
+            "compressed archive. When replaying, datasets are collected from the archive recorded for a dataset "
+            "with the same parameters instead of from Wikipedia, e.g. to re-run a collection with exactly the same "
+            "data.",
+        },
+        "wikitools.archive_folder": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Recording folder",
+            "default": "",
+            "tooltip": "Folder to store recorded API traffic in. Leave empty to use the 'archives' folder in the "
+            "extension folder.",
+        },
+        "wikitools.pagename_ttl": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Page name cache (hours)",
+            "coerce_type": int,
+            "default": 24,
+            "min": 0,
+            "tooltip": "How long to remember the canonical title of a Wikipedia page (after resolving redirects, "
+            "et cetera) before looking it up again. Set to 0 to always look titles up.",
+        },
     }
 
     @classmethod
@@ -110,63 +236,152 @@ class SearchWikiRevisions(Search, WikipediaSearch):
             Path(__file__).absolute().joinpath("../../../GeoLite2-City.mmdb").resolve()
         )
         geolocator = None
+        location_cache = None
         if geoip_database.exists():
-            geolocator = geoip2.database.Reader(geoip_database)
+            # memory-mapped, so lookups don't need to read from disk
+            geolocator = geoip2.database.Reader(
+                str(geoip_database), mode=geoip2.database.MODE_MMAP
+            )
 
-        location_cache = {}
+            # locations are cached per network rather than per address,
+            # since anonymous edits often come from many addresses in the
+            # same range. The cache is kept between datasets, but starts
+            # anew when the database file is updated
+            location_cache = NetworkCache.get_cache(
+                (str(geoip_database), geoip_database.stat().st_mtime),
+                max_size=self.config.get(
+                    "wikirevs-search.geolocation_cache_size", 100000
+                ),
+            )
 
-        num_pages = 0
+        pages = [
+            (language, page)
+            for language, language_pages in self.normalise_pagenames(
+                wiki_apikey, urls
+            ).items()
+            for page in language_pages
+        ]
+
+        # get revisions from API; pages are fetched in parallel, and
+        # revisions are yielded as they come in, so memory use stays the same
+        # regardless of page history
+        rvlimit = self.parameters.get("rvlimit")
+        num_pages = len(pages)
+
+        # long histories are additionally split into periods that are
+        # fetched in parallel
+        shards = 1
+        if rvlimit > 5000:
+            shards = self.config.get("wikirevs-search.history_shards", 8)
+
+        # if collecting this dataset was interrupted before, yield what was
+        # collected then, and continue each page from its earliest revision
+        # collected so far; revisions of a page are collected in order, so
+        # only the ones made in that same second may have been collected
+        # already
         num_revisions = 0
-        for language, pages in self.normalise_pagenames(wiki_apikey, urls).items():
-            for page in pages:
-                num_pages += 1
-
-                # get revisions from API
-                rvlimit = self.parameters.get("rvlimit")
-                page_revisions = self.get_revisions(
-                    wiki_apikey, language, page, rvlimit
-                )
+        checkpoint = self.get_checkpoint()
+        positions = {}
+        for item in checkpoint.iter_records():
+            position = positions.setdefault(
+                (item["language"], item["title"]),
+                {"count": 0, "timestamp": None, "revids": set()},
+            )
+            if item["timestamp"] != position["timestamp"]:
+                position["timestamp"] = item["timestamp"]
+                position["revids"] = set()
+
+            position["revids"].add(item["revid"])
+            position["count"] += 1
+            num_revisions += 1
+            yield item
+
+        if num_revisions:
+            self.dataset.update_status(
+                f"Resuming after {num_revisions:,} revisions collected earlier"
+            )
 
-                if not page_revisions:
-                    continue
+        def get_page_revisions(page):
+            position = positions.get(page)
+            if not position:
+                yield from self.iter_revisions(
+                    wiki_apikey, page[0], page[1], rvlimit, quiet=True, shards=shards
+                )
+                return
+
+            if position["count"] >= rvlimit:
+                return
+
+            for revision in self.iter_revisions(
+                wiki_apikey,
+                page[0],
+                page[1],
+                rvlimit - position["count"] + len(position["revids"]),
+                quiet=True,
+                shards=shards,
+                start=self.parse_timestamp(position["timestamp"]),
+            ):
+                if revision["revid"] not in position["revids"]:
+                    yield revision
+
+        self.dataset.update_status(f"Collecting revisions for {num_pages:,} page(s)")
+        for (language, page), revision in self.stream_concurrently(
+            get_page_revisions,
+            pages,
+            workers=self.config.get("wikirevs-search.max_workers", 4),
+        ):
+            location = ""
+
+            # geolocate only anonymous requests
+            if "anon" in revision and geolocator:
+                location = location_cache.get(revision["user"])
+                if location is None:
+                    try:
+                        geo = geolocator.city(revision["user"])
+                        location = f"{geo.country.iso_code} / {geo.country.name} / {geo.subdivisions.most_specific.name} / {geo.city.name}"
+                        if geo.traits.network:
+                            location_cache.put(geo.traits.network, location)
+                    except (GeoIP2Error, ValueError) as e:
+                        self.dataset.log(
+                            f"Error geolocating IP address {revision['user']}: {e}"
+                        )
+                        location = ""
+                        if getattr(e, "network", None):
+                            location_cache.put(e.network, location)
+
+            item = {
+                "title": page,
+                "language": language,
+                "location": location,
+                **revision,
+            }
+            checkpoint.add(item)
+            yield item
+            num_revisions += 1
 
+            if num_revisions % 500 == 0:
                 self.dataset.update_status(
-                    f"Collected {len(page_revisions):,} revisions for article '{page}' on {language}.wikipedia.org"
+                    f"Collected {num_revisions:,} revisions for {num_pages:,} page(s)"
+                )
+                self.dataset.update_progress(
+                    min(1, num_revisions / (num_pages * rvlimit))
                 )
-
-                for revision in page_revisions:
-                    location = ""
-
-                    # geolocate only anonymous requests
-                    if "anon" in revision and geolocator:
-                        if revision["user"] in location_cache:
-                            location = location_cache[revision["user"]]
-                        else:
-                            try:
-                                geo = geolocator.city(revision["user"])
-                                location = f"{geo.country.iso_code} / {geo.country.name} / {geo.subdivisions.most_specific.name} / {geo.city.name}"
-                                location_cache[revision["user"]] = location
-                            except GeoIP2Error as e:
-                                self.dataset.log(
-                                    f"Error geolocating IP address {revision['user']}: {e}"
-                                )
-                                location = ""
-
-                    yield {
-                        "title": page,
-                        "language": language,
-                        "location": location,
-                        **revision,
-                    }
-                    num_revisions += 1
 
         if geolocator:
             geolocator.close()
+        checkpoint.discard()
         self.dataset.update_status(
             f"Retrieved {num_revisions:,} revisions for {num_pages:,} page(s)",
             is_final=True,
         )
 
+    def clean_up(self):
+        """
+        Close connections to the Wikipedia API and save progress when done
+        """
+        self.close_wiki_transport()
+        self.close_checkpoint()
+
     @staticmethod
     def validate_query(query, request, user):
         """
@@ -199,12 +414,30 @@ class SearchWikiRevisions(Search, WikipediaSearch):
         :param item:  Item collected
         :return MappedItem:  Item mapped for display in CSV files, etc
         """
-        timestamp = datetime.datetime.strptime(item["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+        # this is called for every revision when exporting, so it's worth
+        # avoiding strptime() and regular expressions where possible
+        raw_timestamp = item["timestamp"]
+        if (
+            len(raw_timestamp) == 20
+            and raw_timestamp[10] == "T"
+            and raw_timestamp[19] == "Z"
+        ):
+            timestamp = datetime.datetime.fromisoformat(raw_timestamp[:19])
+            formatted_timestamp = f"{raw_timestamp[:10]} {raw_timestamp[11:19]}"
+        else:
+            timestamp = datetime.datetime.strptime(raw_timestamp, "%Y-%m-%dT%H:%M:%SZ")
+            formatted_timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
 
         section = ""
-        if re.match(r"/\* ([^*]+) \*/", item.get("comment", "")):
-            # this is not foolproof, but a nice extra bit of info
-            section = re.findall(r"/\* (.*) \*/", item["comment"])[0]
+        comment = item.get("comment", "")
+        if comment.startswith("/* "):
+            # comment starts with '/* [section] */', i.e. the first * after
+            # the opening one is part of ' */' and there is something in
+            # between. This is not foolproof, but a nice extra bit of info
+            end = comment.find("*", 3)
+            if end > 4 and comment[end - 1] == " " and comment[end + 1 : end + 2] == "/":
+                match = SECTION_COMMENT.search(comment)
+                section = match.group(1) if match else ""
 
         return MappedItem(
             {
@@ -220,9 +453,9 @@ class SearchWikiRevisions(Search, WikipediaSearch):
                 "is_probably_bot": (
                     "yes" if item["user"].lower().endswith("bot") else "no"
                 ),  # not foolproof, still useful
-                "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                "timestamp": formatted_timestamp,
                 "section": section,
-                "body": item.get("comment", ""),
+                "body": comment,
                 "unix_timestamp": int(timestamp.timestamp()),
             }
         )
@@ -4,13 +4,14 @@ Collect Wikipedia images
 
 from backend.lib.processor import BasicProcessor
 from extensions.wikitools.wikipedia_scraper import WikipediaSearch
+from extensions.wikitools.wikipedia_html import iter_image_sources, get_upload_file
 from common.lib.exceptions import (
     QueryParametersException,
     QueryNeedsExplicitConfirmationException,
 )
 from common.lib.helpers import UserInput
 
-from bs4 import BeautifulSoup
+from urllib.parse import unquote
 
 
 class SearchWikiImages(BasicProcessor, WikipediaSearch):
@@ -27,17 +28,41 @@ class SearchWikiImages(BasicProcessor, WikipediaSearch):
     # not available as a processor for existing datasets
     accepts = [None]
 
+    config = {
+        "wikimages-search.max_workers": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Parallel article requests",
+            "coerce_type": int,
+            "default": 4,
+            "min": 1,
+            "max": 32,
+            "tooltip": "Number of language versions of an article the Wikipedia image scraper retrieves in parallel. "
+            "Higher values are faster but put more load on the Wikipedia API.",
+        },
+        "wikimages-search.max_retries": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Retries per request",
+            "coerce_type": int,
+            "default": 5,
+            "min": 0,
+            "max": 20,
+            "tooltip": "How often the Wikipedia image scraper retries a Wikipedia API request that failed for a reason that is "
+            "likely temporary, such as a server error or time-out. Retries are spaced out exponentially.",
+        },
+    }
+
     options = {
         "intro": {
             "type": UserInput.OPTION_INFO,
-            "help": "For a given Wikipedia URL, retrieve all other languages that article exists in, and then all "
-            "images used on all language versions of that article. Images are displayed side by side to allow "
-            "for visual comparison of the articles, in the order they appear in in the original article.",
+            "help": "For the given Wikipedia URLs, retrieve all other languages those articles exist in, and then "
+            "all images used on all language versions of those articles. Images are displayed side by side to "
+            "allow for visual comparison of the articles, in the order they appear in in the original article.",
         },
         "urls": {
-            "type": UserInput.OPTION_TEXT,
-            "help": "Article URL",
-            "tooltip": "E.g. 'https://en.wikipedia.org/wiki/Man_in_Business_Suit_Levitating_emoji'",
+            "type": UserInput.OPTION_TEXT_LARGE,
+            "help": "Article URLs",
+            "tooltip": "E.g. 'https://en.wikipedia.org/wiki/Man_in_Business_Suit_Levitating_emoji'. Put each URL on a "
+            "separate line.",
         },
     }
 
@@ -48,7 +73,7 @@ class SearchWikiImages(BasicProcessor, WikipediaSearch):
         :param dict query:  Search query parameters
         """
 
-        html = """
+        header = """
         <!DOCTYPE html>
         <head>
           <title>Wikipedia Cross-Lingual Image Analysis &#8226; {url}</title>
@@ -76,117 +101,371 @@ class SearchWikiImages(BasicProcessor, WikipediaSearch):
 
         wiki_apikey = self.config.get("api.wikipedia")
         urls = [url.strip() for url in self.parameters.get("urls").split("\n")]
-        urls = [url for url in urls if url][0]
+        urls = [url for url in urls if url]
         num_images = 0
 
+        # articles each image file occurs in, as `(language, page)` tuples,
+        # with the URL of the article; files are identified by the
+        # repository they were uploaded to and their name
         image_map = {}
-        all_languages = []
+        all_articles = []
         url_map = {}
-        for language, pages in self.normalise_pagenames(wiki_apikey, [urls]).items():
-            page = pages.pop()
-            lang_api = f"https://api.wikimedia.org/core/v1/wikipedia/{language}/page/{page.replace(' ', '_')}/links/language"
 
-            languages = self.wiki_request(wiki_apikey, lang_api)
-            if not languages:
-                self.dataset.update_status(
-                    f"Cannot get language versions for page {page} - may not exist, skipping"
+        # the report is written as articles come in, rather than kept in
+        # memory until the end
+        with self.dataset.get_results_path().open("w") as outfile:
+            outfile.write(header)
+
+            # versions of different seed articles may overlap, e.g. if
+            # versions of the same article in two languages were given, so
+            # collect all versions first and retrieve each only once
+            articles = {}
+            for language, pages in self.normalise_pagenames(
+                wiki_apikey, urls
+            ).items():
+                language_versions = self.get_language_versions(
+                    wiki_apikey, language, pages
                 )
-                continue
-
-            languages.insert(0, {"title": page, "code": language})
-            self.dataset.update_status(
-                f"Found {len(languages)} language versions for Wikipedia page {page}"
-            )
+                for page in pages:
+                    if page not in language_versions:
+                        self.dataset.update_status(
+                            f"Cannot get language versions for page {page} - may not exist, skipping"
+                        )
+                        continue
 
-            languages_done = 0
-            for language_version in languages:
-                page = language_version["title"]
-                page_language = language_version["code"]
+                    self.dataset.update_status(
+                        f"Found {len(language_versions[page]) + 1} language versions for Wikipedia page {page}"
+                    )
+                    articles[(language, page)] = True
+                    for language_version in language_versions[page]:
+                        articles[
+                            (language_version["code"], language_version["title"])
+                        ] = True
+
+            # if collecting this dataset was interrupted before, re-use the
+            # images of articles that were retrieved then
+            checkpoint = self.get_checkpoint()
+            known_images = {
+                (record["language"], record["page"]): record["images"]
+                for record in checkpoint.iter_records()
+            }
+
+            articles_done = 0
+            for (page_language, page), images in self.map_concurrently(
+                lambda article: (
+                    known_images[article]
+                    if article in known_images
+                    else self.get_article_images(wiki_apikey, *article)
+                ),
+                articles,
+                workers=self.config.get("wikimages-search.max_workers", 4),
+            ):
                 page_url = f"https://{page_language}.wikipedia.org/wiki/{page}"
 
-                api_base = f"https://{page_language}.wikipedia.org/w/api.php"
-                languages_done += 1
+                articles_done += 1
                 self.dataset.update_status(
-                    f"Getting images for article {page} ({self.map_lang(page_language)}/{page_language})"
-                )
-                self.dataset.update_progress(languages_done / len(languages))
-
-                # get the image URLs from the page source
-                # since that is the most reliable source of image order
-                image_urls = self.wiki_request(
-                    wiki_apikey,
-                    api_base,
-                    params={"action": "parse", "page": page, "format": "json"},
+                    f"Got images for article {page} ({self.map_lang(page_language)}/{page_language})"
                 )
+                self.dataset.update_progress(articles_done / len(articles))
 
-                if not image_urls:
+                if images is None:
                     self.dataset.update_status(
                         f"Cannot get images for article {page} for language '{page_language}' - skipping"
                     )
                     continue
 
-                all_languages.append(page_language)
-                dom = BeautifulSoup(image_urls["parse"]["text"]["*"], "html.parser")
-                images = dom.find_all("img")
+                all_articles.append((page_language, page))
+                if (page_language, page) not in known_images:
+                    checkpoint.add(
+                        {"language": page_language, "page": page, "images": images}
+                    )
 
-                html += f"""
+                row = [
+                    f"""
                 <tr>
                   <td><a href="https://{page_language}.wikipedia.org/wiki/{page}">{page}</a></td>
                   <td><span title="{page_language}">{self.map_lang(page_language)}</span></td>
                   <td>"""
+                ]
 
-                for image in images:
+                for image_url in images:
                     num_images += 1
-                    image_url = image["src"]
-                    image_filename = image_url.split("/")[-2]
+                    image_file = get_upload_file(image_url)
+                    if image_file:
+                        image_filename = image_file[1]
+                    else:
+                        image_filename = image_url.split("/")[-2]
+                        image_file = (None, image_filename)
+
                     if image_url.startswith("//"):
                         image_url = "https:" + image_url
 
-                    if image_filename not in image_map:
-                        image_map[image_filename] = set()
+                    if image_file not in image_map:
+                        image_map[image_file] = {}
+
+                    image_map[image_file][(page_language, page)] = page_url
+                    url_map[image_file] = image_url
 
-                    image_map[image_filename].add(page_url)
-                    url_map[image_filename] = image_url
+                    row.append(
+                        f'<a href="https://{page_language}.wikipedia.org/wiki/File:{image_filename}"><img src="{image_url}" alt=""></a>'
+                    )
 
-                    html += f'<a href="https://{page_language}.wikipedia.org/wiki/File:{image_filename}"><img src="{image_url}" alt=""></a>'
-                html += """
+                row.append(
+                    """
     </td>
   </tr>
 """
-        html += "</table>"
+                )
+                outfile.write("".join(row))
 
-        html += """
+            outfile.write("</table>")
+            outfile.write(
+                """
   <h2 id="per-image">Article versions per image</h2>
   <table>
   <tr>
     <th>Image</th>
     <th>Occurrences</th>
 """
-        for language in all_languages:
-            html += f'<th><a href="https://{language}.wikipedia.org"><span title="{self.map_lang(language)}">{language}</span></a></th>'
-        html += "</tr>"
-
-        image_map = {
-            k: image_map[k]
-            for k in sorted(image_map, key=lambda v: len(image_map[v]), reverse=True)
-        }
-
-        for image, languages in image_map.items():
-            available_languages = {l.split("/")[2].split(".")[0]: l for l in languages}
-            html += f'<tr><td><a href="https://{list(available_languages.keys())[0]}.wikipedia.org/wiki/File:{image}"><img src="{url_map[image]}" alt=""></a></td>'
-            html += f"<td>{len(available_languages):,}</td>"
-            for language in all_languages:
-                html += "<td>"
-                if language in available_languages:
-                    html += f'<a href="{available_languages[language]}">&times;</a>'
-                html += "</td>"
-        html += "</tr></table></body>"
-
-        with self.dataset.get_results_path().open("w") as outfile:
-            outfile.write(html)
+            )
+            outfile.write(
+                "".join(
+                    [
+                        f'<th><a href="https://{language}.wikipedia.org/wiki/{page}"><span title="{self.map_lang(language)}: {page}">{language}</span></a></th>'
+                        for language, page in all_articles
+                    ]
+                )
+            )
+            outfile.write("</tr>")
 
+            # the same image may be used under different names, e.g. when a
+            # file from Commons was also uploaded to a specific Wikipedia, so
+            # identify images by their content hash where possible
+            uploaded_files = [image_file for image_file in image_map if image_file[0]]
+            self.dataset.update_status(
+                f"Getting metadata for {len(uploaded_files):,} image files"
+            )
+            file_info = self.get_files_info(wiki_apikey, uploaded_files)
+
+            unique_images = {}
+            for image_file, image_articles in image_map.items():
+                info = file_info.get(image_file)
+                identity = info["sha1"] if info else image_file
+                if identity not in unique_images:
+                    unique_images[identity] = {
+                        "name": image_file[1],
+                        "url": url_map[image_file],
+                        "info": info,
+                        "articles": {},
+                    }
+
+                for article, page_url in image_articles.items():
+                    unique_images[identity]["articles"].setdefault(article, page_url)
+
+            for image in sorted(
+                unique_images.values(),
+                key=lambda v: len(v["articles"]),
+                reverse=True,
+            ):
+                available_articles = image["articles"]
+                if image["info"]:
+                    file_url = image["info"]["descriptionurl"]
+                    dimensions = f' title="{image["info"]["width"]:,} &times; {image["info"]["height"]:,}"'
+                else:
+                    file_language = next(iter(available_articles))[0]
+                    file_url = f"https://{file_language}.wikipedia.org/wiki/File:{image['name']}"
+                    dimensions = ""
+
+                row = [
+                    f'<tr><td><a href="{file_url}"><img src="{image["url"]}" alt=""{dimensions}></a></td>',
+                    f"<td>{len(available_articles):,}</td>",
+                ]
+                for article in all_articles:
+                    if article in available_articles:
+                        row.append(
+                            f'<td><a href="{available_articles[article]}">&times;</a></td>'
+                        )
+                    else:
+                        row.append("<td></td>")
+
+                row.append("</tr>")
+                outfile.write("".join(row))
+
+            outfile.write("</table></body>")
+
+        checkpoint.discard()
         return self.dataset.finish(num_images)
 
+    def get_language_versions(self, wiki_apikey, language, pages):
+        """
+        Get other language versions of articles
+
+        Language links are requested for 50 articles at a time.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str language:  Wikipedia language of the articles
+        :param list pages:  Canonical page titles
+        :return dict:  Language versions for each article that exists, as a
+        list of dictionaries with `code` and `title` keys, with page titles
+        as keys
+        """
+        api_base = f"https://{language}.wikipedia.org/w/api.php"
+        language_versions = {}
+        for batch in self.batch_items(pages, 50):
+            params = {
+                "action": "query",
+                "prop": "langlinks",
+                "lllimit": "max",
+                "titles": "|".join(batch),
+                "format": "json",
+                "formatversion": "2",
+            }
+
+            # a limited number of links is returned per request, for all
+            # pages together, so continue until all have been retrieved
+            while True:
+                result = self.wiki_request(wiki_apikey, api_base, params=params)
+                if not result or "query" not in result:
+                    break
+
+                for page in result["query"].get("pages", []):
+                    if page.get("missing") or page.get("invalid"):
+                        continue
+
+                    language_versions.setdefault(page["title"], []).extend(
+                        [
+                            {"code": link["lang"], "title": link["title"]}
+                            for link in page.get("langlinks", [])
+                        ]
+                    )
+
+                if "continue" not in result:
+                    break
+
+                params = {**params, **result["continue"]}
+
+        return language_versions
+
+    def get_article_images(self, wiki_apikey, language, page):
+        """
+        Get images in an article
+
+        Image URLs are taken from the page source, since that is the most
+        reliable source of image order.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str language:  Wikipedia language
+        :param str page:  Page title
+        :return list:  Image URLs, in the order they appear in the article,
+        or `None` if the article could not be retrieved
+        """
+        parsed = self.wiki_request(
+            wiki_apikey,
+            f"https://{language}.wikipedia.org/w/api.php",
+            params={
+                "action": "parse",
+                "page": page,
+                "format": "json",
+                "prop": self.api_fields["parse_images"],
+                "disablelimitreport": "1",
+                "disableeditsection": "1",
+            },
+        )
+
+        if not parsed:
+            return None
+
+        return list(iter_image_sources(parsed["parse"]["text"]["*"]))
+
+    def get_files_info(self, wiki_apikey, files):
+        """
+        Get metadata for uploaded image files
+
+        Files are looked up in batches of 50 per repository they were
+        uploaded to, i.e. Wikimedia Commons or a specific Wikipedia.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param list files:  Files, as `(repository, file name)` tuples
+        :return dict:  Metadata as returned by the API's `imageinfo`
+        property, including the file's `sha1` hash, with the file tuples as
+        keys; files that could not be found are left out
+        """
+        repositories = {}
+        for repository, name in files:
+            repositories.setdefault(repository, []).append(name)
+
+        batches = []
+        for repository, names in repositories.items():
+            batches.extend(
+                [(repository, batch) for batch in self.batch_items(names, 50)]
+            )
+
+        files_info = {}
+        for (repository, names), batch_info in self.map_concurrently(
+            lambda batch: self.get_files_info_batch(wiki_apikey, *batch),
+            batches,
+            workers=self.config.get("wikimages-search.max_workers", 4),
+        ):
+            for name, info in batch_info.items():
+                files_info[(repository, name)] = info
+
+        return files_info
+
+    def get_files_info_batch(self, wiki_apikey, repository, names):
+        """
+        Get metadata for a batch of files from the same repository
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str repository:  Repository the files were uploaded to, e.g.
+        `commons` or `nl`
+        :param list names:  File names, as they occur in the image URL
+        :return dict:  Metadata per file, with file names as keys
+        """
+        if repository == "commons":
+            api_base = "https://commons.wikimedia.org/w/api.php"
+        else:
+            api_base = f"https://{repository}.wikipedia.org/w/api.php"
+
+        titles = {f"File:{unquote(name).replace('_', ' ')}": name for name in names}
+        result = self.wiki_request(
+            wiki_apikey,
+            api_base,
+            params={
+                "action": "query",
+                "prop": "imageinfo",
+                "iiprop": self.api_fields["imageinfo"],
+                "titles": "|".join(titles),
+                "format": "json",
+                "formatversion": "2",
+            },
+        )
+
+        if not result or "query" not in result:
+            self.dataset.log(
+                f"Cannot get metadata for {len(names):,} image file(s) from {api_base} - skipping"
+            )
+            return {}
+
+        # titles are returned in their normalised form, e.g. with the
+        # localised name of the File: namespace
+        for normalised in result["query"].get("normalized", []):
+            if normalised["from"] in titles:
+                titles[normalised["to"]] = titles[normalised["from"]]
+
+        files_info = {}
+        for page in result["query"].get("pages", []):
+            if page.get("imageinfo") and page["title"] in titles:
+                files_info[titles[page["title"]]] = page["imageinfo"][0]
+
+        return files_info
+
+    def clean_up(self):
+        """
+        Close connections to the Wikipedia API and save progress when done
+        """
+        self.close_wiki_transport()
+        self.close_checkpoint()
+
     @staticmethod
     def validate_query(query, request, user):
         """
@@ -201,9 +480,8 @@ class SearchWikiImages(BasicProcessor, WikipediaSearch):
         :return dict:  Safe query parameters
         """
         if not query.get("urls").strip():
-            raise QueryParametersException("You need to provide a valid Wikipedia URL")
-
-        urls = [url.strip() for url in query.get("urls").split("\n")]
-        urls = [[url for url in urls if url][0]]
+            raise QueryParametersException(
+                "You need to provide at least one Wikipedia article URL"
+            )
 
         return {"urls": query.get("urls").strip()}
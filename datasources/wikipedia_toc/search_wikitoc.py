@@ -2,16 +2,18 @@
 Collect Wikipedia tables of content revisions
 """
 
-import json
 import ural
 
 from extensions.wikitools.wikipedia_scraper import WikipediaSearch
+from extensions.wikitools.wikipedia_wikitext import get_wikitext_sections
+from extensions.wikitools.wikipedia_tocdata import (
+    TocEncoder,
+    RevisionChunks,
+    script_json,
+)
 from backend.lib.processor import BasicProcessor
 from common.lib.helpers import UserInput
-from common.lib.exceptions import (
-    QueryParametersException,
-    ProcessorInterruptedException,
-)
+from common.lib.exceptions import QueryParametersException
 
 
 class SearchWikiToc(BasicProcessor, WikipediaSearch):
@@ -55,8 +57,30 @@ class SearchWikiToc(BasicProcessor, WikipediaSearch):
   <script src="https://code.jquery.com/ui/1.14.0/jquery-ui.min.js" integrity="sha256-Fb0zP4jE3JHqu+IBB9YktLcSjI1Zc6J2b6gTjB0LpoM=" crossorigin="anonymous"></script>
   <link rel="stylesheet" href="https://code.jquery.com/ui/1.14.0/themes/base/jquery-ui.css">
   <script>
-  function showTOC(index) {
-    var revision=$("#results").data('revisions').revisions[index];
+  // revisions are embedded in chunks, which are only decoded when needed
+  var decodedChunks={};
+  var decodedOrder=[];
+
+  function getRevision(page,index) {
+    var result=$("#results").data('revisions');
+    var chunk=page.first_chunk+Math.floor(index/result.chunk_size);
+    if(!(chunk in decodedChunks)) {
+        decodedChunks[chunk]=JSON.parse(document.getElementById('chunk-'+chunk).textContent);
+        decodedOrder.push(chunk);
+        // keep the chunks around the slider position only
+        if(decodedOrder.length>8) {
+            delete decodedChunks[decodedOrder.shift()];
+        }
+    }
+
+    var revision=decodedChunks[chunk][index%result.chunk_size];
+    return {revid: revision[0], timestamp: revision[1], user: revision[2], comment: revision[3], toc: revision[4]};
+}
+
+function showTOC(index) {
+    var result=$("#results").data('revisions');
+    var page=result.pages[$("#results").data('page')];
+    var revision=getRevision(page,index);
     /*console.log(revision);*/
     
     if($("#wikitocbrowser").data('rev')!=revision.revid) {
@@ -65,12 +89,14 @@ class SearchWikiToc(BasicProcessor, WikipediaSearch):
         
         var toc='<table id="toc" class="toc"><tr><td><div id="toctitle"><h3>Contents</h3></div><ul>';
         
-        var revurl='http://'+revision.lang+'.wikipedia.org/wiki/'+$("#results").data('revisions').title+'?oldid='+revision.revid;
-        var userurl='http://'+revision.lang+'.wikipedia.org/wiki/User:'+revision.user;
+        var revurl='http://'+page.lang+'.wikipedia.org/wiki/'+page.title+'?oldid='+revision.revid;
+        var userurl='http://'+page.lang+'.wikipedia.org/wiki/User:'+revision.user;
         
+        // TOCs are stored as lists of references to unique sections
+        var entries=result.tocs[revision.toc];
         var level=0;
-        for(var i=0;i<revision.entries.length;i++) {
-            data=revision.entries[i];
+        for(var i=0;i<entries.length;i++) {
+            data=result.sections[entries[i]];
             if(data.toclevel>level) {
                 toc=toc+'<ul>';
             }
@@ -90,12 +116,9 @@ class SearchWikiToc(BasicProcessor, WikipediaSearch):
         
         toc=toc+"</ul></td></tr></table>";
         
-        var revurl='http://'+revision.lang+'.wikipedia.org/wiki/'+$("#results").data('revisions').title+'?oldid='+revision.revid;
-        var userurl='http://'+revision.lang+'.wikipedia.org/wiki/User:'+revision.user;
-        
         $("#wikitocbrowser div.meta").html(
             '<table>'+
-            '<tr><td>Revision</td><td><a href="'+revurl+'">'+revision.revid+'</a> ['+(index+1)+'/'+$("#results").data("revisions").revisions.length+']</td></tr>'+
+            '<tr><td>Revision</td><td><a href="'+revurl+'">'+revision.revid+'</a> ['+(index+1)+'/'+page.num_revisions+']</td></tr>'+
             '<tr><td>Timestamp</td><td>'+revision.timestamp+'</td></tr>'+
             '<tr><td>User</td><td><a href="'+userurl+'">'+revision.user+'</a></td></tr>'+
             '<tr><td>Comment</td><td>'+revision.comment+'</td></tr>'+
@@ -107,8 +130,19 @@ class SearchWikiToc(BasicProcessor, WikipediaSearch):
     }
 }
 
+function showPage(index) {
+    var page=$("#results").data('revisions').pages[index];
+    $("#results").data('page',index);
+    $("#wikitocbrowser").data('rev',-1);
+    $("#wikitocbrowser h1").text(page.title+' ('+page.lang+')');
+    $("#slider").slider("option","max",page.num_revisions-1);
+    $("#slider").slider("value",0);
+    showTOC(0);
+}
+
 function wikitocInitResult(result) {
     $("#results").data('revisions',result);
+    $("#results").data('page',0);
     $('#results').css('display','block');
     $('#results').css('width','93%');
     $('#results').css('margin','0 auto');
@@ -117,28 +151,25 @@ function wikitocInitResult(result) {
     $("#results").html('<div id="wikitocbrowser"></div>');
     $("#wikitocbrowser").css({'padding':'10px','font-size':'16px'});
     $("#wikitocbrowser").data('rev',-1);
-    $("#wikitocbrowser").append('<h1>'+$("#results").data('revisions').title+' ('+$("#results").data('revisions').lang+')</h1>');
-    
-    links='<div style="margin: 1em auto 1em auto;">permalinks: ';
-    
-    link='<a href="'+
-                  window.location.protocol+'//'+window.location.host+window.location.pathname+
-                  '?perm&title='+$("#titleurl").val()+
-                  '&lang='+$("select[name='lang']").val()+
-                  '&maxrv='+$("input[name='maxrv']").val();
-    link=link+'">with updates</a>, ';
-    links=links+link;
-
-    link='<a href="'+
-                  window.location.protocol+'//'+window.location.host+window.location.pathname+
-                  '?perm&title='+$("#titleurl").val()+
-                  '&lang='+$("select[name='lang']").val()+
-                  '&maxrv='+$("input[name='maxrv']").val();
-    link=link+'&last='+$("#results").data('revisions').revisions[0].revid;
-    link=link+'">without updates</a>.</div>';
-    links=links+link;
-    
-    //$("#wikitocbrowser").append(links);   //@todo, this has become obsolete
+    $("#wikitocbrowser").append('<h1></h1>');
+
+    if(result.pages.length==0) {
+        $("#wikitocbrowser h1").text('No revisions could be retrieved');
+        return;
+    }
+
+    // pages are browsed one at a time; switch between them with a menu
+    if(result.pages.length>1) {
+        var menu='<select id="pageselect">';
+        for(var i=0;i<result.pages.length;i++) {
+            menu=menu+'<option value="'+i+'">'+$('<span>').text(result.pages[i].title+' ('+result.pages[i].lang+')').html()+'</option>';
+        }
+        menu=menu+'</select>';
+        $("#wikitocbrowser").append('<div style="margin: 0 0 1em 0;">Page: '+menu+'</div>');
+        $("#pageselect").change(function() {
+            showPage(parseInt($(this).val()));
+        });
+    }
 
     $("#wikitocbrowser").append('<div id="sliderdec">&lt;</div>');
     $("#wikitocbrowser").append('<div id="slider"></div>');
@@ -147,10 +178,9 @@ function wikitocInitResult(result) {
     $("#sliderdec").css({'width':'2%','float':'left','text-align':'center','cursor':'pointer'});
     $("#sliderinc").css({'width':'2%','float':'left','text-align':'center','cursor':'pointer'});
     $("#slider").slider({
-        max   : $("#results").data('revisions').revisions.length-1,
+        max   : result.pages[0].num_revisions-1,
         slide : function(event,ui) {
-                    /*console.log(ui.value);
-                    console.log($("#results").data('revisions').revisions[ui.value]);*/
+                    /*console.log(ui.value);*/
                     showTOC(ui.value);
                 }
     });
@@ -176,35 +206,60 @@ function wikitocInitResult(result) {
     $("#wikitocbrowser .meta").css({'width':'47%','float':'right','border':'1px solid black','margin-top':'1em','font-size':'16px'});
     
     $("#results").append('<div style="clear: both;">&nbsp;</div>');
-    showTOC(0);
+    showPage(0);
     
 }
 $(document).ready(function() {
-    wikitocInitResult(%%json%%);
+    wikitocInitResult(JSON.parse(document.getElementById('tocdata').textContent));
 });
   </script>
 </head>
 <body>
 <div id="results"></div>
+%%data%%
 </body>
 """
 
+    config = {
+        "wikitocs-search.max_workers": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Parallel revision requests",
+            "coerce_type": int,
+            "default": 4,
+            "min": 1,
+            "max": 32,
+            "tooltip": "Number of revisions the Wikipedia TOC scraper parses in parallel, for all pages in a "
+            "dataset together. Higher values are faster but put more load on the Wikipedia API.",
+        },
+        "wikitocs-search.max_retries": {
+            "type": UserInput.OPTION_TEXT,
+            "help": "Retries per request",
+            "coerce_type": int,
+            "default": 5,
+            "min": 0,
+            "max": 20,
+            "tooltip": "How often the Wikipedia TOC scraper retries a Wikipedia API request that failed for a reason that is "
+            "likely temporary, such as a server error or time-out. Retries are spaced out exponentially.",
+        },
+    }
+
     options = {
         "intro": {
             "type": UserInput.OPTION_INFO,
-            "help": "For a given Wikipedia article URL, retrieve a number of revisions of those pages and extract "
-            "the table of contents from the page. This allows for analysis of a page's evolution through "
+            "help": "For the given Wikipedia article URLs, retrieve a number of revisions of those pages and "
+            "extract the table of contents from each revision. This allows for analysis of a page's evolution through "
             "observation of the page's sections.\n\n"
             "Not all historical versions of a page may be available; for example, if the page has been deleted "
             "its contents can no longer be retrieved.\n\n"
             "Note that the retrieval and parsing of historical revisions is a **slow** process, particularly "
             "for large articles! Generally, it is not recommended to collect more than 100 revisions unless "
-            "you are quite sure you need that many.",
+            "you are quite sure you need that many, or extract the TOC from the revisions' wikitext instead.",
         },
         "urls": {
-            "type": UserInput.OPTION_TEXT,
-            "help": "Article URL",
-            "tooltip": "E.g. 'https://en.wikipedia.org/wiki/Man_in_Business_Suit_Levitating_emoji'",
+            "type": UserInput.OPTION_TEXT_LARGE,
+            "help": "Article URLs",
+            "tooltip": "E.g. 'https://en.wikipedia.org/wiki/Man_in_Business_Suit_Levitating_emoji'. Put each URL on a "
+            "separate line. The TOC browser lets you switch between pages.",
         },
         "rvlimit": {
             "type": UserInput.OPTION_TEXT,
@@ -217,95 +272,284 @@ $(document).ready(function() {
             "fewer revisions than the upper limit you set. Things get quite slow when collecting more than "
             "100 revisions!",
         },
+        "extraction": {
+            "type": UserInput.OPTION_CHOICE,
+            "help": "TOC extraction",
+            "options": {
+                "parse": "Parse revisions (exact, slow)",
+                "wikitext": "Extract from wikitext (approximate, fast)",
+            },
+            "default": "parse",
+            "tooltip": "Parsing each revision via Wikipedia gives the table of contents exactly as it was shown on "
+            "the page, but takes one request per revision. Extracting headings from the revisions' wikitext "
+            "takes one request per 50 revisions, but misses headings that are added by templates.",
+        },
     }
 
     def process(self):
         """
         Retrieve TOCs
 
-        todo: this is set up for capturing multiple pages at once, but the UI
-        doesn't deal with that yet
-
         :param dict query:  Search query parameters
         """
         wiki_apikey = self.config.get("api.wikipedia")
         urls = [url.strip() for url in self.parameters.get("urls").split("\n")]
-        urls = [url for url in urls if url][0]
-        tocs = {}
-
-        for language, pages in self.normalise_pagenames(wiki_apikey, [urls]).items():
-            api_base = f"https://{language}.wikipedia.org/w/api.php"
-            pages = list(pages)
-            tocs[language] = {}
-
-            for page in pages:
-                if self.interrupted:
-                    raise ProcessorInterruptedException(
-                        "Interrupted while fetching revisions"
-                    )
+        urls = [url for url in urls if url]
+        rvlimit = self.parameters.get("rvlimit")
+
+        pages = []
+        for language, language_pages in self.normalise_pagenames(
+            wiki_apikey, urls
+        ).items():
+            pages.extend([(language, page) for page in language_pages])
 
-                # get most recent revisions to then parse from API
-                rvlimit = self.parameters.get("rvlimit")
-                num_parsed = 0
-                page_revisions = self.get_revisions(
-                    wiki_apikey, language, page, rvlimit
+        # if collecting this dataset was interrupted before, re-use the TOCs
+        # of revisions that were parsed then
+        checkpoint = self.get_checkpoint()
+        known_sections = {
+            (record["language"], record["revid"]): record["entries"]
+            for record in checkpoint.iter_records()
+        }
+
+        # TOCs are de-duplicated as they come in, to keep the embedded data
+        # small; pages share sections and TOCs, since related articles often
+        # have sections in common. Revisions are written to a file in chunks
+        # as they come in, so they need not be kept in memory
+        encoder = TocEncoder()
+        results_path = self.dataset.get_results_path()
+        chunks = RevisionChunks(
+            results_path.with_name(f"{results_path.stem}.tocdata.ndjson")
+        )
+        num_parsed = 0
+        for language, page, revision in self.get_pages_tocs(
+            wiki_apikey, pages, rvlimit, known_sections
+        ):
+            if (language, revision["revid"]) not in known_sections:
+                checkpoint.add(
+                    {
+                        "language": language,
+                        "revid": revision["revid"],
+                        "entries": revision["entries"],
+                    }
                 )
 
-                for revision in page_revisions:
-                    if self.interrupted:
-                        raise ProcessorInterruptedException(
-                            "Interrupted while parsing revisions"
-                        )
-                    # now get the parsed version of each revision
-                    # this is pretty slow, but the only way to get the TOC...
-                    content = self.wiki_request(
+            num_parsed += 1
+            self.dataset.update_status(
+                f"Parsed {num_parsed:,} revisions, currently for article '{page}' ({self.map_lang(language)}/{language})"
+            )
+            self.dataset.update_progress(num_parsed / (rvlimit * len(pages)))
+
+            chunks.add(language, page, encoder.encode_revision(revision))
+
+        chunks.close()
+
+        # OK, we have our data, let's render it; each chunk of revisions gets
+        # its own script tag, so the browser only needs to decode the chunks
+        # that are being viewed
+        header, footer = self.template.split("%%data%%")
+        with results_path.open("w") as outfile:
+            outfile.write(header)
+            for index, chunk in enumerate(chunks.iter_chunks()):
+                outfile.write(
+                    f'<script type="application/json" id="chunk-{index}">{chunk}</script>\n'
+                )
+
+            embedded_json = {
+                "chunk_size": chunks.chunk_size,
+                "sections": encoder.sections,
+                "tocs": encoder.tocs,
+                "pages": chunks.pages,
+            }
+            outfile.write(
+                f'<script type="application/json" id="tocdata">{script_json(embedded_json)}</script>'
+            )
+            outfile.write(footer)
+
+        chunks.discard()
+        checkpoint.discard()
+        return self.dataset.finish(num_rows=num_parsed)
+
+    def get_pages_tocs(self, wiki_apikey, pages, rvlimit, known_sections=None):
+        """
+        Get tables of contents for the revisions of a number of pages
+
+        Revisions are fetched from the API and their TOCs extracted as they
+        come in. Extraction is done in parallel, since it takes at least one
+        (slow) API call per revision or batch of revisions and is the
+        bottleneck here. Revisions of all pages share the same pool of
+        workers, so work on the next page can start while the last revisions
+        of the previous one are still being parsed.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param list pages:  Pages, as `(language, page)` tuples
+        :param int rvlimit:  Maximum number of revisions to get per page
+        :param dict known_sections:  TOC sections of revisions that do not
+        need to be extracted again, with `(language, revision ID)` tuples as
+        keys
+        :return:  Generator yielding `(language, page, revision)` tuples,
+        with the TOC as the revision's `entries`, per page and most recent
+        revision first
+        """
+        if self.parameters.get("extraction") == "wikitext":
+            get_sections = self.get_wikitext_sections
+            batch_size = 50
+        else:
+            get_sections = self.get_parsed_sections
+            batch_size = 1
+
+        known_sections = known_sections or {}
+
+        def get_batch_sections(batch):
+            language, page, revisions = batch
+            sections = {
+                revision["revid"]: known_sections[(language, revision["revid"])]
+                for revision in revisions
+                if (language, revision["revid"]) in known_sections
+            }
+
+            remaining = [
+                revision for revision in revisions if revision["revid"] not in sections
+            ]
+            if remaining:
+                sections.update(
+                    get_sections(
                         wiki_apikey,
-                        api_base,
-                        params={
-                            "action": "parse",
-                            "format": "json",
-                            "oldid": revision["revid"],
-                            "prop": "sections|revid",
-                        },
+                        f"https://{language}.wikipedia.org/w/api.php",
+                        remaining,
                     )
+                )
 
-                    if not content:
-                        self.dataset.log(
-                            f"Skipping revision {revision['revid']} - could not get data from Wikipedia API"
-                        )
-                        continue
+            return sections
+
+        def get_batches():
+            for language, page in pages:
+                # a page that cannot be found should not end the whole
+                # dataset, so errors are logged rather than made final
+                page_revisions = self.iter_revisions(
+                    wiki_apikey,
+                    language,
+                    page,
+                    rvlimit,
+                    rvprop=self.api_fields["toc_revisions"],
+                    quiet=True,
+                )
 
-                    num_parsed += 1
+                # batches only ever contain revisions of a single page
+                num_revisions = 0
+                for batch in self.batch_items(page_revisions, batch_size):
+                    num_revisions += len(batch)
+                    yield language, page, batch
+
+                if not num_revisions:
                     self.dataset.update_status(
-                        f"Parsing {num_parsed:,}/{len(page_revisions):,} revisions for article '{page}' ({self.map_lang(language)}/{language})"
+                        f"Could not get revisions for '{page}' ({self.map_lang(language)}/{language}), skipping"
                     )
-                    self.dataset.update_progress(num_parsed / len(page_revisions))
-
-                    if page not in tocs[language]:
-                        tocs[language][page] = []
 
-                    tocs[language][page].append(
-                        {**revision, "entries": content["parse"]["sections"]}
+        for (language, page, batch), batch_sections in self.map_concurrently(
+            get_batch_sections,
+            get_batches(),
+            workers=self.config.get("wikitocs-search.max_workers", 4),
+        ):
+            for revision in batch:
+                if not batch_sections or revision["revid"] not in batch_sections:
+                    self.dataset.log(
+                        f"Skipping revision {revision['revid']} - could not get data from Wikipedia API"
                     )
+                    continue
 
-        # OK, we have our data, let's render it
-        num_results = 0
-        embedded_json = ""
-        for language, pages in tocs.items():
-            for page, revisions in pages.items():
-                embedded_json = {
-                    "title": page,
-                    "lang": language,
-                    "revisions": revisions,
+                yield language, page, {
+                    **revision,
+                    "entries": batch_sections[revision["revid"]],
                 }
-                num_results += len(revisions)
+
+    def get_parsed_sections(self, wiki_apikey, api_base, revisions):
+        """
+        Get tables of contents for revisions by parsing them
+
+        Parses each revision via the API; this is pretty slow, but the only
+        way to get the TOC exactly as Wikipedia renders it.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str api_base:  API URL for the revisions' wiki
+        :param list revisions:  Revision metadata
+        :return dict:  TOC sections per revision ID; revisions that could not
+        be parsed are left out
+        """
+        sections = {}
+        for revision in revisions:
+            content = self.wiki_request(
+                wiki_apikey,
+                api_base,
+                params={
+                    "action": "parse",
+                    "format": "json",
+                    "oldid": revision["revid"],
+                    "prop": self.api_fields["parse_sections"],
+                },
+            )
+
+            if content:
+                sections[revision["revid"]] = content["parse"]["sections"]
+
+        return sections
+
+    def get_wikitext_sections(self, wiki_apikey, api_base, revisions):
+        """
+        Get tables of contents for revisions from their wikitext
+
+        Fetches the wikitext of up to 50 revisions with one API call and
+        extracts the TOCs from it locally. This is much faster than parsing
+        each revision, but headings generated by templates are missed.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str api_base:  API URL for the revisions' wiki
+        :param list revisions:  Revision metadata (at most 50)
+        :return dict:  TOC sections per revision ID; revisions for which no
+        wikitext could be retrieved are left out
+        """
+        sections = {}
+        continue_bit = {}
+        while True:
+            content = self.wiki_request(
+                wiki_apikey,
+                api_base,
+                params={
+                    "action": "query",
+                    "format": "json",
+                    "formatversion": "2",
+                    "prop": "revisions",
+                    "revids": "|".join([str(r["revid"]) for r in revisions]),
+                    "rvprop": self.api_fields["revision_content"],
+                    "rvslots": "main",
+                    **continue_bit,
+                },
+            )
+
+            if not content:
+                break
+
+            for page in content["query"].get("pages", []):
+                for revision in page.get("revisions", []):
+                    wikitext = revision.get("slots", {}).get("main", {}).get("content")
+                    if wikitext is not None:
+                        sections[revision["revid"]] = get_wikitext_sections(
+                            wikitext, page["title"]
+                        )
+
+            # the content of large revisions may not fit in one response
+            if content.get("continue"):
+                continue_bit = content["continue"]
+            else:
                 break
-                # todo: implement multi-page drifting/browsing
 
-        with self.dataset.get_results_path().open("w") as outfile:
-            outfile.write(self.template.replace("%%json%%", json.dumps(embedded_json)))
+        return sections
 
-        return self.dataset.finish(num_rows=num_results)
+    def clean_up(self):
+        """
+        Close connections to the Wikipedia API and save progress when done
+        """
+        self.close_wiki_transport()
+        self.close_checkpoint()
 
     @staticmethod
     def validate_query(query, request, user):
@@ -321,6 +565,14 @@ $(document).ready(function() {
         :return dict:  Safe query parameters
         """
         if not query.get("urls").strip():
-            raise QueryParametersException("You need to provide a valid Wikipedia URL")
+            raise QueryParametersException(
+                "You need to provide at least one Wikipedia article URL"
+            )
 
-        return {"urls": query.get("urls").strip(), "rvlimit": query.get("rvlimit")}
+        return {
+            "urls": query.get("urls").strip(),
+            "rvlimit": query.get("rvlimit"),
+            "extraction": (
+                "wikitext" if query.get("extraction") == "wikitext" else "parse"
+            ),
+        }
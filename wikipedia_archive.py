@@ -0,0 +1,191 @@
+"""
+Archives of Wikipedia API traffic, for recording and replaying datasets
+"""
+
+import threading
+import requests
+import hashlib
+import json
+import gzip
+import time
+import zlib
+
+from requests.structures import CaseInsensitiveDict
+
+
+class TrafficArchive:
+    """
+    Recorded Wikipedia API requests and their responses
+
+    When recording, every response received is appended to a gzipped JSON
+    lines file, together with the URL and parameters of the request it was
+    a response to. When replaying, responses are looked up in that file
+    instead of being requested from the API, so a dataset can be collected
+    again with exactly the same data, at disk speed and without network
+    access.
+
+    If the same request was recorded more than once (e.g. because it was
+    retried, or because the dataset was recorded again), the response
+    recorded last is replayed.
+    """
+
+    # response headers that are recorded; others are not used
+    headers = ("Content-Type", "Retry-After")
+
+    def __init__(self, path, mode):
+        """
+        Open archive
+
+        :param Path path:  Path to the archive file
+        :param str mode:  `record` to add responses to the archive, or
+        `replay` to read responses from it
+        """
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.num_recorded = 0
+        self.num_replayed = 0
+        self.num_missing = 0
+        self.damaged = False
+        self.file = None
+
+        if mode == "record":
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists():
+                self.repair()
+            self.file = gzip.open(path, "at", encoding="utf-8")
+        elif path.exists():
+            self.load()
+
+    @staticmethod
+    def get_key(url, params):
+        """
+        Get archive key for a request
+
+        :param str url:  Request URL
+        :param dict params:  Request parameters
+        :return str:  Key
+        """
+        params = {key: str(value) for key, value in (params or {}).items()}
+        return hashlib.sha1(
+            json.dumps([url, params], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def read_records(self):
+        """
+        Read records from the archive file
+
+        If recording was interrupted, the file may end in an incomplete
+        record or gzip member. Reading stops there, and `damaged` is set.
+
+        :return:  Generator yielding `(line, record)` tuples
+        """
+        self.damaged = False
+        with gzip.open(self.path, "rt", encoding="utf-8") as infile:
+            try:
+                for line in infile:
+                    if not line.endswith("\n"):
+                        raise EOFError("Incomplete record")
+
+                    yield line, json.loads(line)
+            except (EOFError, OSError, ValueError):
+                self.damaged = True
+
+    def load(self):
+        """
+        Read recorded responses from the archive file
+
+        Response bodies are kept in memory compressed. If recording was
+        interrupted, the last record may be incomplete; it is ignored.
+        """
+        for line, record in self.read_records():
+            self.responses[self.get_key(record["url"], record["params"])] = (
+                record["status"],
+                record["headers"],
+                zlib.compress(record["body"].encode("utf-8")),
+            )
+
+    def repair(self):
+        """
+        Remove the damaged end of the archive file, if any
+
+        Records are appended to the archive in a new gzip member each time
+        it is recorded to. If an earlier recording was interrupted, the file
+        ends in an incomplete member, and anything appended after it could
+        not be read. So before recording, the readable records are copied to
+        a new file, which then replaces the damaged one.
+        """
+        for _ in self.read_records():
+            pass
+
+        if not self.damaged:
+            return
+
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with gzip.open(temp_path, "wt", encoding="utf-8") as outfile:
+            for line, record in self.read_records():
+                outfile.write(line)
+
+        temp_path.replace(self.path)
+
+    def record(self, url, params, response):
+        """
+        Add a response to the archive
+
+        :param str url:  Request URL
+        :param dict params:  Request parameters
+        :param requests.Response response:  Response
+        """
+        record = {
+            "url": url,
+            "params": {key: str(value) for key, value in (params or {}).items()},
+            "status": response.status_code,
+            "headers": {
+                header: response.headers[header]
+                for header in self.headers
+                if header in response.headers
+            },
+            "body": response.text,
+            "recorded_at": time.time(),
+        }
+
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.num_recorded += 1
+
+    def replay(self, url, params):
+        """
+        Get recorded response to a request
+
+        :param str url:  Request URL
+        :param dict params:  Request parameters
+        :return requests.Response:  Response, or `None` if no response to
+        this request was recorded
+        """
+        recorded = self.responses.get(self.get_key(url, params))
+        with self.lock:
+            if not recorded:
+                self.num_missing += 1
+                return None
+
+            self.num_replayed += 1
+
+        status, headers, body = recorded
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = zlib.decompress(body)
+        response.encoding = "utf-8"
+        response.url = url
+
+        return response
+
+    def close(self):
+        """
+        Close archive file, if recording
+        """
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
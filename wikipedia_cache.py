@@ -0,0 +1,425 @@
+"""
+Persistent caches for Wikipedia API data
+"""
+
+import collections
+import ipaddress
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import zlib
+
+from pathlib import Path
+
+cache_lock = threading.Lock()
+
+
+class SQLiteCache:
+    """
+    Base class for caches stored in an SQLite database
+
+    There is one cache object per class and database file, shared between
+    all processors using it; get it with `get_cache()`. Several caches may
+    use the same database file, so it is opened in WAL mode, and writers
+    wait for each other for a while rather than failing straight away. The
+    cache is not essential, so if the database cannot be read or written
+    after all, subclasses treat that as a cache miss. If the database cannot
+    be opened at all, `get_cache()` raises an `sqlite3.Error` or `OSError`,
+    and callers should do without the cache.
+    """
+
+    caches = {}
+    tables = []
+
+    def __init__(self, path):
+        """
+        Open cache database
+
+        :param Path path:  Path to the SQLite database file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(str(path), timeout=5, check_same_thread=False)
+        try:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # in WAL mode, this is still safe, but commits don't need an fsync
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            for table in self.tables:
+                self.db.execute(table)
+            self.db.commit()
+        except sqlite3.Error:
+            # e.g. a read-only folder; don't leave the connection open
+            self.db.close()
+            raise
+
+    @classmethod
+    def get_cache(cls, path=None):
+        """
+        Get shared cache object for a database file
+
+        :param Path path:  Path to the SQLite database file; by default, a
+        file in the extension's root folder
+        :return SQLiteCache:  Cache
+        """
+        if not path:
+            path = Path(__file__).parent.joinpath("wikipedia_cache.sqlite")
+
+        with cache_lock:
+            if (cls, path) not in cls.caches:
+                cls.caches[(cls, path)] = cls(path)
+
+            return cls.caches[(cls, path)]
+
+
+class ResponseCache(SQLiteCache):
+    """
+    On-disk cache for Wikipedia API responses
+
+    Meant for responses that never change, e.g. the parsed version of a
+    specific revision. Responses are stored compressed. When the cache grows
+    beyond its size limit, the least recently used responses are removed.
+
+    When responses are read, their access time is not updated in the
+    database straight away, but in batches, so that reading from the cache
+    does not require a write to disk every time.
+    """
+
+    tables = [
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "  key TEXT PRIMARY KEY,"
+        "  body BLOB NOT NULL,"
+        "  size INTEGER NOT NULL,"
+        "  last_access REAL NOT NULL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)",
+    ]
+
+    def __init__(self, path):
+        """
+        Open cache database
+
+        :param Path path:  Path to the SQLite database file
+        """
+        super().__init__(path)
+        self.max_size = 1024 * 1024 * 1024
+        self.accessed = {}
+        self.accessed_flushed = time.monotonic()
+        self.size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @classmethod
+    def get_cache(cls, path=None, max_size=1024 * 1024 * 1024):
+        """
+        Get shared cache object for a database file
+
+        :param Path path:  Path to the SQLite database file; by default, a
+        file in the extension's root folder
+        :param int max_size:  Maximum size of the cached responses, in bytes
+        :return ResponseCache:  Cache
+        """
+        cache = super().get_cache(path)
+        cache.max_size = max_size
+
+        return cache
+
+    @staticmethod
+    def get_key(url, params):
+        """
+        Get cache key for a request
+
+        :param str url:  Request URL
+        :param dict params:  Request parameters
+        :return str:  Cache key
+        """
+        params = {key: str(value) for key, value in (params or {}).items()}
+        return hashlib.sha1(
+            json.dumps([url, params], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key):
+        """
+        Get cached response
+
+        :param str key:  Cache key
+        :return str:  Response body, or `None` if not cached
+        """
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    "SELECT body FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+
+            if not row:
+                return None
+
+            self.accessed[key] = time.time()
+            if (
+                len(self.accessed) >= 100
+                or time.monotonic() - self.accessed_flushed >= 60
+            ):
+                try:
+                    self.flush_accessed()
+                    self.db.commit()
+                except sqlite3.Error:
+                    # access times are only used for eviction, and can be
+                    # slightly off
+                    self.db.rollback()
+
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def flush_accessed(self):
+        """
+        Save access times of responses read since the last flush
+
+        Must be called with the cache's lock held; the changes still need to
+        be committed.
+        """
+        accessed = self.accessed
+        self.accessed = {}
+        self.db.executemany(
+            "UPDATE responses SET last_access = ? WHERE key = ?",
+            [(timestamp, key) for key, timestamp in accessed.items()],
+        )
+        self.accessed_flushed = time.monotonic()
+
+    def put(self, key, body):
+        """
+        Store response in the cache
+
+        If this makes the cache exceed its maximum size, the least recently
+        used responses are removed until it is at 90% of the maximum size.
+
+        :param str key:  Cache key
+        :param str body:  Response body
+        """
+        body = zlib.compress(body.encode("utf-8"))
+        with self.lock:
+            try:
+                existing = self.db.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, body, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, body, len(body), time.time()),
+                )
+                self.size += len(body) - (existing[0] if existing else 0)
+
+                if self.size > self.max_size:
+                    # access times need to be up to date to know which
+                    # responses were used least recently
+                    self.accessed.pop(key, None)
+                    self.flush_accessed()
+
+                    target = self.max_size * 0.9
+                    evicted = []
+                    for old_key, size in self.db.execute(
+                        "SELECT key, size FROM responses ORDER BY last_access ASC"
+                    ):
+                        if self.size <= target:
+                            break
+                        evicted.append((old_key,))
+                        self.size -= size
+
+                    self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+                self.db.commit()
+            except sqlite3.Error:
+                # not cached, then; the size may be off now, so re-count
+                self.db.rollback()
+                try:
+                    self.size = self.db.execute(
+                        "SELECT COALESCE(SUM(size), 0) FROM responses"
+                    ).fetchone()[0]
+                except sqlite3.Error:
+                    pass
+
+
+class PageNameCache(SQLiteCache):
+    """
+    On-disk cache for canonical Wikipedia page names
+
+    Maps page names as they appear in URLs to the canonical title of the
+    page they refer to, per language. Entries expire after a given time. If
+    it turns out that a page has been moved or turned into a redirect,
+    entries pointing to its old title are marked as stale, so they are
+    looked up again rather than returning an outdated title.
+    """
+
+    tables = [
+        "CREATE TABLE IF NOT EXISTS pagenames ("
+        "  language TEXT NOT NULL,"
+        "  raw_title TEXT NOT NULL,"
+        "  canonical_title TEXT NOT NULL,"
+        "  resolved_at REAL NOT NULL,"
+        "  stale INTEGER NOT NULL DEFAULT 0,"
+        "  PRIMARY KEY (language, raw_title)"
+        ")",
+        "CREATE INDEX IF NOT EXISTS pagenames_canonical ON pagenames (language, canonical_title)",
+    ]
+
+    def get(self, language, raw_title, ttl):
+        """
+        Get canonical title for a page name
+
+        :param str language:  Wikipedia language
+        :param str raw_title:  Page name, e.g. from a URL
+        :param int ttl:  Maximum age of the cached title, in seconds
+        :return str:  Canonical title, or `None` if not cached, expired or
+        stale
+        """
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    "SELECT canonical_title FROM pagenames WHERE language = ? AND raw_title = ? "
+                    "AND stale = 0 AND resolved_at >= ?",
+                    (language, raw_title, time.time() - ttl),
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+
+        return row[0] if row else None
+
+    def update(self, language, titles):
+        """
+        Store canonical titles for page names
+
+        Cached entries that are contradicted by the new titles are marked as
+        stale: those that resolved to a title that the same page name now no
+        longer resolves to (i.e. the page was moved), and those that resolved
+        to a title that now is a redirect itself.
+
+        :param str language:  Wikipedia language
+        :param dict titles:  Canonical titles, with page names as keys
+        """
+        now = time.time()
+        with self.lock:
+            try:
+                for raw_title, canonical_title in titles.items():
+                    previous = self.db.execute(
+                        "SELECT canonical_title FROM pagenames WHERE language = ? AND raw_title = ?",
+                        (language, raw_title),
+                    ).fetchone()
+
+                    if previous and previous[0] != canonical_title:
+                        self.db.execute(
+                            "UPDATE pagenames SET stale = 1 WHERE language = ? AND canonical_title = ?",
+                            (language, previous[0]),
+                        )
+
+                    if raw_title != canonical_title:
+                        self.db.execute(
+                            "UPDATE pagenames SET stale = 1 WHERE language = ? AND canonical_title = ?",
+                            (language, raw_title),
+                        )
+
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO pagenames (language, raw_title, canonical_title, resolved_at, stale) "
+                        "VALUES (?, ?, ?, ?, 0)",
+                        (language, raw_title, canonical_title, now),
+                    )
+
+                self.db.commit()
+            except sqlite3.Error:
+                # not cached, then
+                self.db.rollback()
+
+
+class NetworkCache:
+    """
+    In-memory cache of values per IP network
+
+    Values (e.g. geolocations) are stored for a whole network, such as the
+    network a geolocation database returns for an IP address, so that they
+    can be retrieved for any address in that network. The cache is kept for
+    as long as 4CAT runs and shared between all processors using it; get it
+    with `get_cache()`. When it is full, the least recently used networks
+    are removed.
+    """
+
+    caches = {}
+
+    def __init__(self, max_size=100000):
+        """
+        Set up cache
+
+        :param int max_size:  Maximum number of networks to store
+        """
+        self.max_size = max_size
+        self.networks = collections.OrderedDict()
+        self.prefixes = collections.Counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_cache(cls, name, max_size=100000):
+        """
+        Get shared cache object
+
+        :param name:  Cache identifier; a new, empty cache is created for
+        each identifier
+        :param int max_size:  Maximum number of networks to store
+        :return NetworkCache:  Cache
+        """
+        with cache_lock:
+            if name not in cls.caches:
+                cls.caches[name] = cls(max_size)
+
+            cache = cls.caches[name]
+            cache.max_size = max_size
+            return cache
+
+    def get(self, address):
+        """
+        Get value for an IP address
+
+        :param str address:  IP address
+        :return:  Value stored for the network the address is in, or `None`
+        if no such network is cached
+        """
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+
+        with self.lock:
+            # only a few distinct prefix lengths are typically used, so
+            # check each of them rather than all networks
+            for version, prefix_length in list(self.prefixes):
+                if version != address.version:
+                    continue
+
+                network = ipaddress.ip_network((address, prefix_length), strict=False)
+                if network in self.networks:
+                    self.networks.move_to_end(network)
+                    return self.networks[network]
+
+        return None
+
+    def put(self, network, value):
+        """
+        Store value for an IP network
+
+        :param network:  IP network, as string (e.g. `192.0.2.0/24`) or
+        `ipaddress` network object
+        :param value:  Value to store
+        """
+        network = ipaddress.ip_network(network, strict=False)
+        with self.lock:
+            if network not in self.networks:
+                self.prefixes[(network.version, network.prefixlen)] += 1
+
+            self.networks[network] = value
+            self.networks.move_to_end(network)
+
+            while len(self.networks) > self.max_size:
+                evicted, _ = self.networks.popitem(last=False)
+                prefix = (evicted.version, evicted.prefixlen)
+                self.prefixes[prefix] -= 1
+                if not self.prefixes[prefix]:
+                    del self.prefixes[prefix]
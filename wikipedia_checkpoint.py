@@ -0,0 +1,145 @@
+"""
+Checkpoints for resuming interrupted Wikipedia datasets
+"""
+
+import hashlib
+import json
+import time
+import os
+
+
+class Checkpoint:
+    """
+    Saved progress of a dataset that is being collected
+
+    Datasources add a record to the checkpoint for every unit of work that
+    is done (e.g. a revision that has been parsed), and can read the records
+    back when the same dataset is collected again after an interruption, to
+    skip work that has been done already.
+
+    Records are appended to a journal file next to the dataset's result
+    file. Periodically, the journal is flushed to disk and its size saved to
+    a state file; when resuming, anything after that point is discarded, so
+    a crash halfway through writing a record cannot corrupt the checkpoint.
+    Both files are removed when the dataset has been collected completely.
+    """
+
+    # increase when the format of the saved state changes
+    version = 1
+
+    def __init__(self, results_path, parameters, interval=10):
+        """
+        Open checkpoint
+
+        If a checkpoint was saved for a dataset with different parameters,
+        it is discarded.
+
+        :param Path results_path:  Path to the dataset's result file
+        :param dict parameters:  Dataset parameters
+        :param float interval:  Save the checkpoint at most this often, in
+        seconds
+        """
+        self.state_path = results_path.with_name(f"{results_path.stem}.checkpoint.json")
+        self.journal_path = results_path.with_name(
+            f"{results_path.stem}.checkpoint.ndjson"
+        )
+        self.key = hashlib.sha1(
+            json.dumps(parameters, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        self.interval = interval
+        self.saved_at = time.monotonic()
+
+        try:
+            state = json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            state = {}
+
+        self.journal_size = 0
+        if (
+            state.get("version") == self.version
+            and state.get("key") == self.key
+            and self.journal_path.exists()
+        ):
+            self.journal_size = state["journal_size"]
+
+        # records after the last save may be incomplete, so drop them
+        self.journal = self.journal_path.open("a+b")
+        self.journal.truncate(self.journal_size)
+        self.journal.seek(0, os.SEEK_END)
+
+    @property
+    def resumed(self):
+        """
+        Whether there is saved progress to resume from
+
+        :return bool:  `True` if records were saved earlier
+        """
+        return self.journal_size > 0
+
+    def iter_records(self):
+        """
+        Iterate through records saved by a previous attempt
+
+        :return:  Generator yielding records, in the order they were added
+        """
+        with self.journal_path.open("rb") as infile:
+            remaining = self.journal_size
+            for line in infile:
+                if remaining <= 0:
+                    break
+
+                remaining -= len(line)
+                yield json.loads(line)
+
+    def add(self, record):
+        """
+        Add record to the checkpoint
+
+        The checkpoint is saved if this has not been done for a while.
+
+        :param record:  Record; anything that can be serialised as JSON
+        """
+        self.journal.write(json.dumps(record).encode("utf-8") + b"\n")
+        if time.monotonic() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Save checkpoint to disk
+        """
+        if self.journal.closed:
+            return
+
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_size = self.journal.tell()
+
+        # write to a temporary file first, so the state is replaced at once
+        temp_path = self.state_path.with_suffix(".tmp")
+        temp_path.write_text(
+            json.dumps(
+                {
+                    "version": self.version,
+                    "key": self.key,
+                    "journal_size": self.journal_size,
+                    "saved_at": time.time(),
+                }
+            )
+        )
+        os.replace(temp_path, self.state_path)
+        self.saved_at = time.monotonic()
+
+    def close(self):
+        """
+        Save and close checkpoint
+        """
+        self.save()
+        self.journal.close()
+
+    def discard(self):
+        """
+        Remove checkpoint, when the dataset has been collected completely
+        """
+        self.journal.close()
+        self.state_path.unlink(missing_ok=True)
+        self.journal_path.unlink(missing_ok=True)
@@ -0,0 +1,102 @@
+"""
+Local helpers for working with Wikipedia HTML
+"""
+
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+
+class ImageSourceParser(HTMLParser):
+    """
+    Collect `src` attributes of `img` tags
+
+    Rather than building a document tree, tags are handled as the HTML is
+    tokenised and everything but `img` tags is ignored.
+    """
+
+    def __init__(self):
+        """
+        Set up parser
+        """
+        super().__init__()
+        self.sources = []
+
+    def handle_starttag(self, tag, attrs):
+        """
+        Collect image source, if this is an image
+
+        Self-closing tags (`<img />`) are also passed to this method.
+
+        :param str tag:  Tag name, lowercased
+        :param list attrs:  Tag attributes, as `(name, value)` tuples
+        """
+        if tag != "img":
+            return
+
+        # if an attribute occurs more than once, the last one counts
+        src = None
+        for name, value in attrs:
+            if name == "src":
+                src = value
+
+        if src is not None:
+            self.sources.append(src)
+
+
+def iter_image_sources(html, chunk_size=65536):
+    """
+    Get sources of images in a piece of HTML, in document order
+
+    The HTML is tokenised in chunks, and sources are yielded as they are
+    found. This gives the same result as `find_all("img")` on a
+    BeautifulSoup tree built with the `html.parser` parser, without building
+    that tree. Images without a `src` attribute are skipped.
+
+    :param str html:  HTML to extract images from
+    :param int chunk_size:  Number of characters to tokenise at a time
+    :return:  Generator yielding image sources, as strings
+    """
+    parser = ImageSourceParser()
+    for offset in range(0, len(html), chunk_size):
+        parser.feed(html[offset : offset + chunk_size])
+        yield from parser.sources
+        parser.sources = []
+
+    parser.close()
+    yield from parser.sources
+
+
+def get_upload_file(image_url):
+    """
+    Get the file an image on upload.wikimedia.org is a version of
+
+    Works for both full-size images and thumbnails, e.g.
+    `//upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Example.jpg/220px-Example.jpg`
+    is a version of the file `Example.jpg` on Wikimedia Commons.
+
+    :param str image_url:  Image URL
+    :return tuple:  The repository the file was uploaded to (e.g. `commons`,
+    or `nl` for a file uploaded to the Dutch Wikipedia) and the file name as
+    it occurs in the URL, or `None` if the URL is not of an uploaded file
+    """
+    url = urlparse(image_url)
+    path = url.path.strip("/").split("/")
+    if (
+        url.hostname != "upload.wikimedia.org"
+        or len(path) < 5
+        or path[0] != "wikipedia"
+    ):
+        return None
+
+    repository = path[1]
+    if path[2] == "thumb":
+        path = path[3:]
+    else:
+        path = path[2:]
+
+    # files are stored in folders named after the first characters of the
+    # MD5 hash of their name, e.g. a/ab/Example.jpg
+    if len(path) < 3 or len(path[0]) != 1 or len(path[1]) != 2:
+        return None
+
+    return repository, path[2]
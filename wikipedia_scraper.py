@@ -1,10 +1,30 @@
-import requests
+import collections
+import itertools
+import threading
+import datetime
+import hashlib
+import sqlite3
+import queue
+import json
 import ural
 import re
+import time
 
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import unquote, urlparse
 from requests.exceptions import RequestException
 from common.lib.exceptions import ProcessorInterruptedException
+from extensions.wikitools.wikipedia_transport import (
+    WikipediaTransport,
+    RateGovernor,
+    RetryPolicy,
+)
+from extensions.wikitools.wikipedia_cache import ResponseCache, PageNameCache
+from extensions.wikitools.wikipedia_checkpoint import Checkpoint
+from extensions.wikitools.wikipedia_archive import TrafficArchive
+
+transport_lock = threading.Lock()
 
 
 class WikipediaSearch:
@@ -347,11 +367,305 @@ class WikipediaSearch:
         "zh-classical": "Classical Chinese",
     }
 
+    # fields to request from the API for each type of request; ask only for
+    # what is actually used, since everything else makes responses larger
+    # and slower to decode
+    api_fields = {
+        # first revision of a page, to know how far back its history goes
+        "revision_bounds": "timestamp",
+        # revision metadata, as stored by the revisions scraper
+        "revisions": "ids|timestamp|flags|comment|user",
+        # revision metadata, as shown in the TOC browser
+        "toc_revisions": "ids|timestamp|comment|user",
+        # revision wikitext, for extracting TOCs
+        "revision_content": "ids|content",
+        # parsed revision, for its TOC
+        "parse_sections": "sections",
+        # parsed article, for its images
+        "parse_images": "text",
+        # image file metadata, for identifying copies of the same image
+        "imageinfo": "sha1|url|size",
+    }
+
+    wiki_transport = None
+    checkpoint = None
+
+    def get_wiki_transport(self):
+        """
+        Get HTTP transport for Wikipedia API requests
+
+        The transport is created on first use and kept for the lifetime of
+        the processor, so connections can be re-used between requests. Call
+        `close_wiki_transport()` when done.
+
+        Depending on the `wikitools.transport_mode` setting, all traffic is
+        recorded to an archive, or replayed from one (see
+        `get_archive_path()`). When recording, the response cache is not
+        used, so that the archive is complete; when replaying, requests are
+        neither rate limited nor retried, since they are not actually sent.
+
+        :return WikipediaTransport:  Transport
+        """
+        with transport_lock:
+            if not self.wiki_transport:
+                mode = self.config.get("wikitools.transport_mode", "live")
+                archive = None
+                if mode in ("record", "replay"):
+                    archive = TrafficArchive(self.get_archive_path(), mode)
+                    if mode == "record":
+                        if archive.damaged:
+                            self.dataset.log(
+                                f"An earlier recording to {archive.path} was interrupted; removed its "
+                                f"incomplete last part"
+                            )
+                        self.dataset.log(
+                            f"Recording Wikipedia API traffic to {archive.path}"
+                        )
+                    elif archive.responses:
+                        self.dataset.log(
+                            f"Replaying {len(archive.responses):,} recorded Wikipedia API response(s) from "
+                            f"{archive.path}"
+                        )
+                    else:
+                        self.dataset.log(
+                            f"No recorded Wikipedia API traffic found at {archive.path}; requests will fail"
+                        )
+
+                cache = None
+                if mode == "live" and self.config.get("wikitools.cache_enabled", False):
+                    try:
+                        cache = ResponseCache.get_cache(
+                            max_size=self.config.get("wikitools.cache_size", 1024)
+                            * 1024
+                            * 1024
+                        )
+                    except (sqlite3.Error, OSError) as e:
+                        # the cache is not essential, so do without
+                        self.dataset.log(
+                            f"Could not open Wikipedia API response cache ({e}), continuing without it"
+                        )
+
+                # rate limits are shared between all datasources and jobs
+                governors = {
+                    budget: RateGovernor.get_governor(
+                        budget, self.config.get(f"wikitools.rate_limit_{budget}", rate)
+                    )
+                    for budget, rate in (("authenticated", 20), ("anonymous", 5))
+                    if mode != "replay"
+                }
+
+                self.wiki_transport = WikipediaTransport(
+                    max_connections=self.config.get(
+                        "wikitools.max_connections_per_host", 4
+                    ),
+                    cache=cache,
+                    governors=governors,
+                    retry_policy=RetryPolicy(
+                        max_retries=(
+                            self.config.get(f"{self.type}.max_retries", 5)
+                            if mode != "replay"
+                            else 0
+                        )
+                    ),
+                    url_override=self.config.get("wikitools.api_url_override", ""),
+                    archive=archive,
+                )
+
+            return self.wiki_transport
+
+    def close_wiki_transport(self):
+        """
+        Close HTTP transport and any connections it holds open
+        """
+        with transport_lock:
+            if not self.wiki_transport:
+                return
+
+            transport = self.wiki_transport
+            self.wiki_transport = None
+
+        transport.close()
+        if transport.stats["retries"]:
+            self.dataset.log(
+                f"Retried {transport.stats['retries']:,} failed Wikipedia API request(s)"
+            )
+
+        if transport.cache:
+            self.dataset.log(
+                f"Response cache: {transport.stats['cache_hits']:,} hit(s), "
+                f"{transport.stats['cache_misses']:,} miss(es)"
+            )
+
+        if transport.archive and transport.archive.mode == "record":
+            self.dataset.log(
+                f"Recorded {transport.archive.num_recorded:,} Wikipedia API response(s) to "
+                f"{transport.archive.path}"
+            )
+        elif transport.archive:
+            self.dataset.log(
+                f"Replayed {transport.archive.num_replayed:,} Wikipedia API response(s); "
+                f"{transport.archive.num_missing:,} request(s) had no recorded response"
+            )
+
+        self.log_request_metrics(transport.metrics.get_summary())
+
+    def log_request_metrics(self, summary):
+        """
+        Log a summary of request metrics
+
+        A short summary is written to the dataset log; the full summary is
+        saved as JSON in a `.metrics.json` file next to the dataset's result
+        file.
+
+        :param dict summary:  Summary, as returned by
+        `RequestMetrics.get_summary()`
+        """
+        totals = summary["totals"]
+        if not totals["requests"]:
+            return
+
+        self.dataset.log(
+            f"Sent {totals['requests']:,} Wikipedia API request(s) and received "
+            f"{totals['bytes'] / 1024 / 1024:,.1f} MB; {totals['latency']:,.1f}s spent waiting for responses, "
+            f"{totals['waited']:,.1f}s waiting for rate limits and retries, {totals['parse_time']:,.1f}s parsing "
+            f"responses"
+        )
+
+        # the JSON file has metrics per host; in the log, combine hosts, since
+        # a dataset may span hundreds of language versions
+        actions = {}
+        for endpoint in summary["endpoints"]:
+            action = endpoint["action"] or endpoint["endpoint"]
+            if action not in actions:
+                actions[action] = {
+                    "hosts": 0,
+                    "requests": 0,
+                    "latency": 0,
+                    "max_latency": 0,
+                    "failed": 0,
+                    "histogram": collections.Counter(),
+                }
+
+            metrics = actions[action]
+            metrics["hosts"] += 1
+            metrics["requests"] += endpoint["requests"]
+            metrics["latency"] += endpoint["latency"]
+            metrics["max_latency"] = max(metrics["max_latency"], endpoint["max_latency"])
+            # cache hits are recorded without a status
+            metrics["failed"] += sum(
+                [count for status, count in endpoint["statuses"].items() if status != "200"]
+            ) - endpoint["cache"].get("hit", 0)
+            metrics["histogram"].update(endpoint["histogram"])
+
+        for action, metrics in actions.items():
+            histogram = ", ".join(
+                [f"{bucket}: {count:,}" for bucket, count in metrics["histogram"].items() if count]
+            )
+            failed = f", {metrics['failed']:,} failed" if metrics["failed"] else ""
+            self.dataset.log(
+                f"{action}: {metrics['requests']:,} request(s) to {metrics['hosts']:,} host(s){failed}, mean "
+                f"latency {metrics['latency'] / metrics['requests']:.2f}s, max {metrics['max_latency']:.2f}s "
+                f"({histogram})"
+            )
+
+        for request in summary["slowest"][:5]:
+            params = ", ".join(
+                [f"{key}={value}" for key, value in request["params"].items()]
+            )
+            self.dataset.log(
+                f"Slow request: {request['latency']:.2f}s for {request['action'] or request['endpoint']} "
+                f"({request['host']}; {params})"
+            )
+
+        results_path = self.dataset.get_results_path()
+        metrics_path = results_path.with_name(f"{results_path.stem}.metrics.json")
+        with metrics_path.open("w") as outfile:
+            json.dump(summary, outfile, indent=2)
+
+    def get_archive_path(self):
+        """
+        Get path of the archive to record API traffic to or replay it from
+
+        Archives are named after the datasource and the dataset's
+        parameters, so a dataset collected with the same parameters as one
+        that was recorded earlier replays that recording.
+
+        :return Path:  Path to the archive file
+        """
+        folder = self.config.get("wikitools.archive_folder", "")
+        folder = Path(folder) if folder else Path(__file__).parent.joinpath("archives")
+        key = hashlib.sha1(
+            json.dumps(self.parameters, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+        return folder.joinpath(f"{self.type}-{key}.jsonl.gz")
+
+    def get_checkpoint(self):
+        """
+        Get checkpoint for the dataset that is being collected
+
+        If collecting the dataset was interrupted before, the checkpoint
+        contains the progress made then.
+
+        :return Checkpoint:  Checkpoint
+        """
+        if not self.checkpoint:
+            self.checkpoint = Checkpoint(
+                self.dataset.get_results_path(), self.parameters
+            )
+            if self.checkpoint.resumed:
+                self.dataset.log("Resuming from progress saved earlier")
+
+        return self.checkpoint
+
+    def close_checkpoint(self):
+        """
+        Save and close checkpoint, if one was opened
+
+        Called when processing ends for whatever reason; if the dataset is
+        collected again later, it resumes from this point.
+        """
+        if self.checkpoint and not self.checkpoint.journal.closed:
+            self.checkpoint.close()
+
+    @staticmethod
+    def is_immutable_request(params):
+        """
+        Determine whether the response to a request will never change
+
+        This is the case for requests for a specific revision, e.g. parsing
+        it or getting its content; such responses can be cached forever.
+
+        :param dict params:  Request parameters
+        :return bool:  Whether the response is immutable
+        """
+        params = params or {}
+        if params.get("action") == "parse":
+            return "oldid" in params and "page" not in params
+
+        if params.get("action") == "query":
+            return params.get("prop") == "revisions" and "revids" in params
+
+        return False
+
     def wiki_request(self, auth="", *args, **kwargs):
         """
         Send a Wikipedia API request
 
-        Does some error handling and authentication scaffolding.
+        Does some error handling and authentication scaffolding. Requests are
+        sent through a pooled transport (see `get_wiki_transport()`). If the
+        response cache is enabled, responses that will never change are
+        served from and stored in the cache.
+
+        Requests are rate limited. If the API indicates that it is being sent
+        too many requests, or that its servers are lagging, the request is
+        retried after waiting as long as the API asks, and the request rate
+        is reduced for a while. Requests that fail for other reasons that are
+        likely temporary are retried according to the transport's retry
+        policy.
+
+        Timing and traffic metrics are recorded for each request; see
+        `close_wiki_transport()` for the summary.
 
         :param str auth:  Wikipedia API auth key (can be empty)
         :param args:  Positional arguments are passed to `requests.get`
@@ -363,27 +677,182 @@ class WikipediaSearch:
                 kwargs["headers"] = {}
             kwargs["headers"]["Authorization"] = f"Bearer {auth}"
 
+        transport = self.get_wiki_transport()
+        url = urlparse(args[0])
+        params = kwargs.get("params") or {}
+        metrics = {
+            "host": url.hostname,
+            "endpoint": self.get_endpoint(url.path),
+            "action": "/".join(
+                [str(params[p]) for p in ("action", "prop", "list") if params.get(p)]
+            ),
+            "params": {
+                key: value
+                for key, value in params.items()
+                if key not in ("format", "formatversion")
+            },
+            "latency": 0,
+            "waited": 0,
+            "parse_time": 0,
+        }
+
+        cache_key = None
+        if transport.cache and self.is_immutable_request(kwargs.get("params")):
+            cache_key = transport.cache.get_key(args[0], kwargs.get("params"))
+            cached = transport.cache.get(cache_key)
+            if cached is not None:
+                transport.count("cache_hits")
+                transport.metrics.record(cache="hit", **metrics)
+                return json.loads(cached)
+
+            transport.count("cache_misses")
+            metrics["cache"] = "miss"
+
+        # ask the action API to refuse requests when its servers are lagging,
+        # rather than adding to the load
+        if args[0].endswith("/api.php"):
+            kwargs["params"] = {"maxlag": 5, **kwargs.get("params", {})}
+
+        governor = transport.get_governor(bool(auth))
+        retry_policy = transport.retry_policy
+        throttled = 0
+        retries = 0
+        result = None
+        error = None
         try:
-            result = requests.get(*args, **kwargs)
-            print(result.text)
+            while True:
+                if governor:
+                    waited = governor.wait()
+                    transport.count("throttle_wait", waited)
+                    metrics["waited"] += waited
+
+                result = None
+                result_json = {}
+                error = None
+                try:
+                    started = time.monotonic()
+                    try:
+                        result = transport.get(*args, **kwargs)
+                    finally:
+                        # also count time spent on requests that time out
+                        metrics["latency"] += time.monotonic() - started
+
+                    if result.status_code == 200:
+                        started = time.monotonic()
+                        result_json = result.json()
+                        metrics["parse_time"] += time.monotonic() - started
+                except (ValueError, RequestException) as e:
+                    error = e
+
+                if not error:
+                    retry_after = self.get_retry_after(result, result_json)
+                    if retry_after is False:
+                        if governor:
+                            governor.speed_up()
+                    else:
+                        # throttled; wait as long as needed, this is not an error
+                        throttled += 1
+                        transport.count("throttled")
+                        if governor:
+                            governor.slow_down(retry_after)
+                        elif retry_after:
+                            time.sleep(retry_after)
+                            metrics["waited"] += retry_after
+
+                        if throttled < 25 and not self.interrupted:
+                            continue
+
+                        error = ValueError("rate limited")
+                        break
+
+                    if result.status_code == 200 and "error" not in result_json:
+                        break
+
+                if (
+                    retries >= retry_policy.max_retries
+                    or self.interrupted
+                    or not retry_policy.is_retryable(result, result_json, error)
+                ):
+                    break
+
+                retries += 1
+                transport.count("retries")
+                delay = retry_policy.get_delay(retries)
+                reason = error if error else f"status {result.status_code}"
+                self.dataset.log(
+                    f"Wikipedia API request failed ({reason}), retrying in {delay:.1f} seconds "
+                    f"(retry {retries}/{retry_policy.max_retries})"
+                )
+                time.sleep(delay)
+                metrics["waited"] += delay
+        finally:
+            # record failed requests too, including ones that raised
+            transport.metrics.record(
+                size=len(result.content) if result is not None else 0,
+                status=result.status_code if result is not None else None,
+                retries=retries,
+                **metrics,
+            )
+
+        try:
+            if error:
+                raise error
+
             if result.status_code != 200:
                 raise ValueError(f"Wikipedia API request failed ({result.status_code})")
 
-            result_json = result.json()
-
             if "error" in result_json:
                 raise ValueError(
                     f"Wikipedia API request failed ({result_json['error'].get('info', result_json['error'])})"
                 )
 
-            return result_json
-
         except (ValueError, RequestException) as e:
             self.dataset.log(
                 f"Encountered an error interfacing with the Wikipedia API ({e})"
             )
             return None
 
+        if cache_key:
+            transport.cache.put(cache_key, result.text)
+
+        return result_json
+
+    @staticmethod
+    def get_endpoint(path):
+        """
+        Get the endpoint a request is sent to, for request metrics
+
+        For REST API paths, the page title is replaced with a placeholder,
+        so that requests for different pages count as the same endpoint.
+
+        :param str path:  URL path
+        :return str:  Endpoint
+        """
+        return re.sub(r"/page/[^/]+", "/page/{title}", path)
+
+    @staticmethod
+    def get_retry_after(result, result_json):
+        """
+        Determine whether the API asked to retry a request later
+
+        This is the case when too many requests are being sent (429), or
+        when the API's servers are lagging (a `maxlag` error).
+
+        :param requests.Response result:  API response
+        :param dict result_json:  Parsed API response
+        :return:  `False` if the request does not need to be retried;
+        otherwise the number of seconds to wait before retrying, or `None`
+        if the API did not say
+        """
+        error = result_json.get("error", {}) if isinstance(result_json, dict) else {}
+        if result.status_code != 429 and error.get("code") != "maxlag":
+            return False
+
+        try:
+            return float(result.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
     def normalise_pagenames(self, auth, urls):
         """
         Normalise Wikipedia page names
@@ -437,20 +906,42 @@ class WikipediaSearch:
             f"Collecting canonical article names for {len(parsed_urls):,} Wikipedia article(s)"
         )
 
+        # canonical titles are cached across datasets, since the same pages
+        # tend to be requested over and over - but not when recording or
+        # replaying, since the lookups are part of the traffic
+        ttl = self.config.get("wikitools.pagename_ttl", 24) * 3600
+        pagename_cache = None
+        if ttl > 0 and self.config.get("wikitools.transport_mode", "live") == "live":
+            try:
+                pagename_cache = PageNameCache.get_cache()
+            except (sqlite3.Error, OSError) as e:
+                self.dataset.log(
+                    f"Could not open Wikipedia page name cache ({e}), continuing without it"
+                )
+
         # sort by language (so we can batch requests)
         result = {}
         for language, pages in parsed_urls.items():
             api_base = f"https://{language}.wikipedia.org/w/api.php"
-            pages = list(pages)
             canonical_titles = []
+            uncached_pages = []
+            for page in pages:
+                canonical_title = (
+                    pagename_cache.get(language, page, ttl) if pagename_cache else None
+                )
+                if canonical_title:
+                    if canonical_title not in canonical_titles:
+                        canonical_titles.append(canonical_title)
+                else:
+                    uncached_pages.append(page)
+
+            if uncached_pages:
+                self.dataset.update_status(
+                    f"Collecting canonical article names for articles on {language}.wikipedia.org ({self.map_lang(language)})"
+                )
 
-            self.dataset.update_status(
-                f"Collecting canonical article names for articles on {language}.wikipedia.org ({self.map_lang(language)})"
-            )
             # get canonical title for URL
-            while pages:
-                batch = pages[:50]
-                pages = pages[50:]
+            for batch in self.batch_items(uncached_pages, 50):
                 canonical = self.wiki_request(
                     auth,
                     api_base,
@@ -468,14 +959,35 @@ class WikipediaSearch:
                     )
                     continue
 
+                existing_titles = set()
                 for page in canonical["query"]["pages"].values():
-                    canonical_titles.append(page["title"])
+                    if page["title"] not in canonical_titles:
+                        canonical_titles.append(page["title"])
+                    if "missing" not in page and "invalid" not in page:
+                        existing_titles.add(page["title"])
+
+                if pagename_cache:
+                    # trace how each page name was resolved, so the result
+                    # can be cached per page name
+                    resolved = {}
+                    for page in batch:
+                        title = page
+                        for step in ("normalized", "converted", "redirects"):
+                            for mapping in canonical["query"].get(step, []):
+                                if mapping["from"] == title:
+                                    title = mapping["to"]
+                                    break
+
+                        if title in existing_titles:
+                            resolved[page] = title
+
+                    pagename_cache.update(language, resolved)
 
             result[language] = canonical_titles
 
         return {lang: result[lang] for lang in result if result[lang]}
 
-    def get_revisions(self, wiki_apikey, language, page, rvlimit=500):
+    def get_revisions(self, wiki_apikey, language, page, rvlimit=500, rvprop=None):
         """
         Get revisions for a given page
 
@@ -486,12 +998,312 @@ class WikipediaSearch:
         :param str language:  Wikipedia language
         :param str page:  Wikipedia page
         :param int rvlimit:  Maximum number of revisions to return
+        :param str rvprop:  Revision fields to get; by default, those in
+        `api_fields["revisions"]`
         :return list:  List of dictionaries with revision metadata
         """
         page_revisions = []
+        for revisions_batch in self.get_revision_batches(
+            wiki_apikey, language, page, rvlimit, rvprop
+        ):
+            page_revisions += revisions_batch
+
+        return page_revisions
+
+    def iter_revisions(
+        self,
+        wiki_apikey,
+        language,
+        page,
+        rvlimit=500,
+        rvprop=None,
+        quiet=False,
+        shards=1,
+        start=None,
+    ):
+        """
+        Iterate through revisions for a given page
+
+        Like `get_revisions()`, but revisions are yielded as soon as they are
+        received from the API rather than collected first, so memory use does
+        not depend on the number of revisions.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str language:  Wikipedia language
+        :param str page:  Wikipedia page
+        :param int rvlimit:  Maximum number of revisions to return
+        :param str rvprop:  Revision fields to get; by default, those in
+        `api_fields["revisions"]`
+        :param bool quiet:  Log errors instead of updating the dataset status
+        (e.g. when called from a worker thread)
+        :param int shards:  If more than 1, split the page history into
+        periods and fetch up to this many of those in parallel (see
+        `iter_revisions_sharded()`)
+        :param int start:  Only get revisions made at or before this UNIX
+        timestamp, e.g. to continue where an earlier attempt left off
+        :return:  Generator yielding dictionaries with revision metadata
+        """
+        if shards > 1:
+            yield from self.iter_revisions_sharded(
+                wiki_apikey,
+                language,
+                page,
+                rvlimit,
+                rvprop,
+                quiet,
+                shards,
+                start=start,
+            )
+            return
+
+        for revisions_batch in self.get_revision_batches(
+            wiki_apikey,
+            language,
+            page,
+            rvlimit,
+            rvprop,
+            quiet,
+            rvrange=(start, None) if start is not None else None,
+        ):
+            yield from revisions_batch
+
+    def iter_revisions_sharded(
+        self,
+        wiki_apikey,
+        language,
+        page,
+        rvlimit=500,
+        rvprop=None,
+        quiet=False,
+        shards=8,
+        workers=4,
+        start=None,
+    ):
+        """
+        Iterate through revisions for a given page, in parallel
+
+        Revisions can normally only be fetched one batch after another. For
+        pages with a long history, this fetches the most recent batch as
+        usual, and uses how often the page was edited in that time to split
+        the history before it into periods that should each fit in one batch.
+        These periods are fetched in parallel, and revisions are yielded in
+        order (most recent first), as if they had been fetched in one go.
+
+        The estimate of how often the page was edited is updated as periods
+        come in. Periods that turn out to hold more than a batch of
+        revisions are completed one batch after another; if the periods run
+        out before `rvlimit` revisions have been found, the history before
+        them is split again. At most `shards` periods are fetched or waiting
+        to be yielded at a time, so memory use does not depend on the number
+        of revisions.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str language:  Wikipedia language
+        :param str page:  Wikipedia page
+        :param int rvlimit:  Maximum number of revisions to return
+        :param str rvprop:  Revision fields to get; by default, those in
+        `api_fields["revisions"]`
+        :param bool quiet:  Log errors instead of updating the dataset status
+        (e.g. when called from a worker thread)
+        :param int shards:  Maximum number of periods to fetch ahead
+        :param int workers:  Number of periods to fetch in parallel
+        :param int start:  Only get revisions made at or before this UNIX
+        timestamp
+        :return:  Generator yielding dictionaries with revision metadata
+        """
+        batch_size = 500
+        # leave some room in each period for revisions that are spread
+        # unevenly, so most periods can be fetched with one request
+        period_size = int(batch_size * 0.8)
+
+        # revisions are yielded in order, so only revisions made in the same
+        # second as the last one yielded may be yielded twice
+        position = {"timestamp": None, "revids": set(), "count": 0}
+
+        def new_revisions(revisions):
+            for revision in revisions:
+                if revision["timestamp"] != position["timestamp"]:
+                    position["timestamp"] = revision["timestamp"]
+                    position["revids"] = set()
+                elif revision["revid"] in position["revids"]:
+                    continue
+
+                position["revids"].add(revision["revid"])
+                position["count"] += 1
+                yield revision
+                if position["count"] >= rvlimit:
+                    return
+
+        def get_rest(earliest, quiet):
+            # revisions between the last one yielded and a timestamp, one
+            # batch after another
+            yield from new_revisions(
+                itertools.chain.from_iterable(
+                    self.get_revision_batches(
+                        wiki_apikey,
+                        language,
+                        page,
+                        rvlimit - position["count"] + len(position["revids"]),
+                        rvprop,
+                        quiet=quiet,
+                        rvrange=(self.parse_timestamp(position["timestamp"]), earliest),
+                    )
+                )
+            )
+
+        def get_period(period):
+            return list(
+                itertools.chain.from_iterable(
+                    self.get_revision_batches(
+                        wiki_apikey,
+                        language,
+                        page,
+                        batch_size,
+                        rvprop,
+                        quiet=True,
+                        rvrange=period,
+                    )
+                )
+            )
+
+        # the most recent batch is needed anyway
+        revisions = next(
+            self.get_revision_batches(
+                wiki_apikey,
+                language,
+                page,
+                min(batch_size, rvlimit),
+                rvprop,
+                quiet,
+                rvrange=(start, None),
+            ),
+            [],
+        )
+        yield from new_revisions(revisions)
+        if len(revisions) < batch_size or position["count"] >= rvlimit:
+            return
+
+        # timestamp of the first revision, so no periods before it are
+        # fetched
+        response = self.wiki_request(
+            wiki_apikey,
+            f"https://{language}.wikipedia.org/w/api.php",
+            params={
+                "action": "query",
+                "format": "json",
+                "prop": "revisions",
+                "rvprop": self.api_fields["revision_bounds"],
+                "rvlimit": 1,
+                "rvdir": "newer",
+                "titles": page,
+            },
+        )
+        first = [
+            revision
+            for page_details in (response or {}).get("query", {}).get("pages", {}).values()
+            for revision in page_details.get("revisions", [])
+        ]
+        if not first:
+            # can't determine history length; fetch the normal way instead
+            yield from get_rest(None, quiet)
+            return
+
+        first = self.parse_timestamp(first[0]["timestamp"])
+        interval = max(
+            1,
+            self.parse_timestamp(revisions[0]["timestamp"])
+            - self.parse_timestamp(revisions[-1]["timestamp"]),
+        ) / len(revisions)
+
+        if not quiet:
+            self.dataset.update_status(
+                f"Fetching revisions for '{page}' ({self.map_lang(language)}/{language}) in parallel"
+            )
+
+        def get_periods(latest, num_periods):
+            # periods are a whole number of seconds and do not overlap, since
+            # timestamp bounds are inclusive
+            for i in range(num_periods):
+                earliest = max(first, latest - max(1, int(period_size * interval)) + 1)
+                yield latest, earliest
+                if earliest <= first:
+                    return
+
+                latest = earliest - 1
+
+        latest = self.parse_timestamp(position["timestamp"])
+        while latest >= first and position["count"] < rvlimit:
+            num_periods = -(-(rvlimit - position["count"]) // period_size)
+            periods = self.map_concurrently(
+                get_period,
+                get_periods(latest, num_periods),
+                workers=workers,
+                window=shards,
+            )
+            try:
+                for (period_latest, period_earliest), revisions in periods:
+                    num_revisions = position["count"]
+                    yield from new_revisions(revisions)
+                    if len(revisions) >= batch_size and position["count"] < rvlimit:
+                        # more revisions than estimated
+                        yield from get_rest(period_earliest, True)
+
+                    if position["count"] >= rvlimit:
+                        return
+
+                    # periods that are fetched already were planned with the
+                    # previous estimate, so don't let one period that is
+                    # much busier or quieter than those skew it too much
+                    period_interval = (period_latest - period_earliest + 1) / max(
+                        1, position["count"] - num_revisions
+                    )
+                    interval = min(interval * 4, max(interval / 4, period_interval))
+                    latest = period_earliest - 1
+            finally:
+                periods.close()
+
+    def get_revision_batches(
+        self,
+        wiki_apikey,
+        language,
+        page,
+        rvlimit=500,
+        rvprop=None,
+        quiet=False,
+        rvrange=None,
+    ):
+        """
+        Get revisions for a given page, per batch
+
+        Like `get_revisions()`, but yields each batch of revisions as soon as
+        it has been received from the API, so callers can start working with
+        them while the next batch is being fetched.
+
+        :param str wiki_apikey:  Wikipedia API key
+        :param str language:  Wikipedia language
+        :param str page:  Wikipedia page
+        :param int rvlimit:  Maximum number of revisions to return
+        :param str rvprop:  Revision fields to get; by default, those in
+        `api_fields["revisions"]`
+        :param bool quiet:  Log errors instead of updating the dataset status
+        (e.g. when called from a worker thread)
+        :param tuple rvrange:  Only get revisions between these two UNIX
+        timestamps (latest first, both inclusive); either may be `None` for
+        no limit
+        :return:  Generator yielding lists of dictionaries with revision
+        metadata
+        """
+        num_revisions = 0
         continue_bit = {}
+        range_bit = {}
+        if rvrange:
+            if rvrange[0] is not None:
+                range_bit["rvstart"] = self.format_timestamp(rvrange[0])
+            if rvrange[1] is not None:
+                range_bit["rvend"] = self.format_timestamp(rvrange[1])
+
         api_base = f"https://{language}.wikipedia.org/w/api.php"
-        while len(page_revisions) < rvlimit:
+        while num_revisions < rvlimit:
             if self.interrupted:
                 raise ProcessorInterruptedException(
                     "Interrupted while fetching revisions"
@@ -504,39 +1316,213 @@ class WikipediaSearch:
                     "action": "query",
                     "format": "json",
                     "prop": "revisions",
-                    "rvlimit": rvlimit,
+                    "rvprop": rvprop or self.api_fields["revisions"],
+                    "rvlimit": min(500, rvlimit - num_revisions),
                     "titles": page,
+                    **range_bit,
                     **continue_bit,
                 },
             )
 
-            self.dataset.update_status(
-                f"Fetching revision {len(page_revisions):,}-{min(rvlimit, len(page_revisions) + 500):,} for '{page}' ({self.map_lang(language)}/{language})"
-            )
-
-            if not revisions_batch:
+            if not quiet:
                 self.dataset.update_status(
-                    f"Could not get revisions for {page} from Wikipedia API - skipping"
+                    f"Fetching revision {num_revisions:,}-{min(rvlimit, num_revisions + 500):,} for '{page}' ({self.map_lang(language)}/{language})"
                 )
+
+            if not revisions_batch:
+                message = f"Could not get revisions for {page} from Wikipedia API - skipping"
+                if quiet:
+                    self.dataset.log(message)
+                else:
+                    self.dataset.update_status(message)
                 break
 
             for page_id, page_details in revisions_batch["query"]["pages"].items():
                 if page_id == "-1":
                     reason = page_details.get("invalidreason", "unknown error")
-                    self.dataset.update_status(
-                        f"Could not fetch revisions for page {page} (Wikipedia said: '{reason}') - halting. Double-check the URL and try again.",
-                        is_final=True,
-                    )
-                    return []
+                    if quiet:
+                        self.dataset.log(
+                            f"Could not fetch revisions for page {page} (Wikipedia said: '{reason}') - skipping"
+                        )
+                    else:
+                        self.dataset.update_status(
+                            f"Could not fetch revisions for page {page} (Wikipedia said: '{reason}') - halting. Double-check the URL and try again.",
+                            is_final=True,
+                        )
+                    return
 
-                page_revisions += page_details["revisions"]
+                revisions = page_details["revisions"][: rvlimit - num_revisions]
+                num_revisions += len(revisions)
+                yield revisions
 
             if revisions_batch.get("continue"):
                 continue_bit = {"rvcontinue": revisions_batch["continue"]["rvcontinue"]}
             else:
                 break
 
-        return page_revisions
+    def stream_concurrently(self, function, items, workers=4, buffer=100):
+        """
+        Iterate through generators for a number of items in parallel
+
+        Each item is passed to the generator function in a worker thread.
+        Results are yielded as soon as any of the workers produces them, so
+        results for different items are interleaved; they are paired with
+        the item they belong to. Workers pause when `buffer` results per
+        worker are waiting to be consumed, so memory use stays limited.
+
+        :param callable function:  Generator function to call; receives one
+        item as its argument
+        :param items:  Iterable of items
+        :param int workers:  Number of worker threads
+        :param int buffer:  Maximum number of results per worker to keep
+        waiting
+        :return:  Generator yielding `(item, result)` tuples
+        """
+        workers = max(1, int(workers))
+        results = queue.Queue(maxsize=workers * buffer)
+        stop = threading.Event()
+
+        def put(message):
+            # don't block forever if the consumer has gone away
+            while not stop.is_set():
+                try:
+                    results.put(message, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def work(item):
+            try:
+                for result in function(item):
+                    if not put(("result", item, result)):
+                        return
+            except Exception as e:
+                put(("error", item, e))
+            finally:
+                put(("done", item, None))
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            remaining = 0
+            for item in items:
+                pool.submit(work, item)
+                remaining += 1
+
+            while remaining:
+                if self.interrupted:
+                    raise ProcessorInterruptedException(
+                        "Interrupted while processing items"
+                    )
+
+                try:
+                    status, item, result = results.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                if status == "done":
+                    remaining -= 1
+                elif status == "error":
+                    raise result
+                else:
+                    yield item, result
+        finally:
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def map_concurrently(self, function, items, workers=4, window=None):
+        """
+        Call a function for a number of items with a pool of worker threads
+
+        Items are taken from the iterable lazily, so work can start on the
+        first items while the iterable is still producing the rest (e.g.
+        while further pages are fetched from the API). At most `window`
+        items are queued or in progress at any time. Results are yielded in
+        the same order as the items.
+
+        :param callable function:  Function to call; receives one item as
+        its argument
+        :param items:  Iterable of items
+        :param int workers:  Number of worker threads
+        :param int window:  Maximum number of items in progress; by default,
+        twice the number of workers
+        :return:  Generator yielding `(item, result)` tuples
+        """
+        workers = max(1, int(workers))
+        window = window or workers * 2
+        pending = collections.deque()
+
+        def work(item):
+            # don't start new work if the processor is being interrupted
+            if self.interrupted:
+                return None
+            return function(item)
+
+        def next_result():
+            if self.interrupted:
+                raise ProcessorInterruptedException(
+                    "Interrupted while processing items"
+                )
+            item, future = pending.popleft()
+            return item, future.result()
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for item in items:
+                pending.append((item, pool.submit(work, item)))
+                while len(pending) >= window or (pending and pending[0][1].done()):
+                    yield next_result()
+
+            while pending:
+                yield next_result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        """
+        Parse a timestamp as the API returns it
+
+        :param str timestamp:  ISO 8601 timestamp, e.g. `2024-01-01T00:00:00Z`
+        :return int:  UNIX timestamp
+        """
+        return int(
+            datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+            .replace(tzinfo=datetime.timezone.utc)
+            .timestamp()
+        )
+
+    @staticmethod
+    def format_timestamp(timestamp):
+        """
+        Format a UNIX timestamp as the API expects it
+
+        :param int timestamp:  UNIX timestamp
+        :return str:  ISO 8601 timestamp, e.g. `2024-01-01T00:00:00Z`
+        """
+        return datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc
+        ).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    @staticmethod
+    def batch_items(items, size):
+        """
+        Split an iterable into lists of a given size
+
+        :param items:  Iterable to split
+        :param int size:  Batch size; the last batch may be smaller
+        :return:  Generator yielding lists of items
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
 
     def map_lang(self, code):
         """
@@ -0,0 +1,176 @@
+"""
+Compact storage of tables of contents for the TOC browser
+"""
+
+import json
+
+
+class TocEncoder:
+    """
+    De-duplicate tables of contents across revisions
+
+    Consecutive revisions of an article mostly have the same table of
+    contents, or one that differs by a section or two. Rather than storing
+    the full TOC for each revision, each unique section is stored once, each
+    unique TOC is stored once as a list of references to those sections, and
+    revisions refer to a TOC by its index. The size of the encoded data thus
+    depends on the number of distinct TOCs, not the number of revisions.
+    """
+
+    # fields of each section that the TOC browser uses
+    section_fields = ("toclevel", "index", "number", "line", "anchor")
+
+    # fields of each revision that the TOC browser uses
+    revision_fields = ("revid", "timestamp", "user", "comment")
+
+    def __init__(self):
+        """
+        Set up encoder
+        """
+        self.sections = []
+        self.section_ids = {}
+        self.tocs = []
+        self.toc_ids = {}
+
+    def encode(self, entries):
+        """
+        Encode a table of contents
+
+        :param list entries:  TOC sections, as returned by the `action=parse`
+        API endpoint
+        :return int:  Index of the TOC in `tocs`
+        """
+        toc = []
+        for entry in entries:
+            section = tuple([entry.get(field) for field in self.section_fields])
+            if section not in self.section_ids:
+                self.section_ids[section] = len(self.sections)
+                self.sections.append(dict(zip(self.section_fields, section)))
+
+            toc.append(self.section_ids[section])
+
+        toc = tuple(toc)
+        if toc not in self.toc_ids:
+            self.toc_ids[toc] = len(self.tocs)
+            self.tocs.append(list(toc))
+
+        return self.toc_ids[toc]
+
+    def encode_revision(self, revision):
+        """
+        Encode a revision's table of contents
+
+        :param dict revision:  Revision metadata, with the TOC as `entries`
+        :return list:  The revision's `revision_fields`, followed by the
+        index of its TOC
+        """
+        return [revision.get(field, "") for field in self.revision_fields] + [
+            self.encode(revision["entries"])
+        ]
+
+
+class RevisionChunks:
+    """
+    Encoded revisions, stored in chunks for the TOC browser
+
+    Revisions are written to a file as they are added, a chunk of a fixed
+    number of revisions at a time, so they do not need to be kept in memory.
+    The TOC browser embeds each chunk separately and only decodes the chunks
+    around the revision that is being viewed, so neither the processor nor
+    the browser needs to handle all revisions at once.
+
+    Revisions must be added page by page; each page's revisions start in a
+    new chunk.
+    """
+
+    chunk_size = 100
+
+    def __init__(self, path):
+        """
+        Open chunk file
+
+        :param Path path:  Path to the file to store chunks in
+        """
+        self.path = path
+        self.file = path.open("w")
+        self.pages = []
+        self.chunk = []
+        self.num_chunks = 0
+
+    def add(self, language, page, revision):
+        """
+        Add revision
+
+        :param str language:  Wikipedia language of the page
+        :param str page:  Page title
+        :param revision:  Revision, as encoded by `TocEncoder`
+        """
+        if not self.pages or (self.pages[-1]["lang"], self.pages[-1]["title"]) != (
+            language,
+            page,
+        ):
+            self.flush()
+            self.pages.append(
+                {
+                    "title": page,
+                    "lang": language,
+                    "num_revisions": 0,
+                    "first_chunk": self.num_chunks,
+                }
+            )
+
+        self.chunk.append(revision)
+        self.pages[-1]["num_revisions"] += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the current chunk to the file, if it has any revisions
+        """
+        if not self.chunk:
+            return
+
+        self.file.write(script_json(self.chunk) + "\n")
+        self.num_chunks += 1
+        self.chunk = []
+
+    def close(self):
+        """
+        Write the last chunk and close the file
+        """
+        self.flush()
+        self.file.close()
+
+    def iter_chunks(self):
+        """
+        Iterate through the stored chunks
+
+        :return:  Generator yielding chunks as JSON that can be embedded in
+        a `script` tag (see `script_json()`), in the order they were added
+        """
+        with self.path.open() as infile:
+            for line in infile:
+                yield line.rstrip("\n")
+
+    def discard(self):
+        """
+        Remove the chunk file
+        """
+        if not self.file.closed:
+            self.file.close()
+
+        self.path.unlink(missing_ok=True)
+
+
+def script_json(data):
+    """
+    Serialise data as JSON that can be embedded in a `script` tag
+
+    `</` is escaped, so strings in the data (e.g. edit comments) cannot end
+    the script tag early.
+
+    :param data:  Data to serialise
+    :return str:  JSON
+    """
+    return json.dumps(data, separators=(",", ":")).replace("</", "<\\/")
@@ -0,0 +1,510 @@
+"""
+HTTP transport for the Wikipedia APIs
+"""
+
+import collections
+import threading
+import requests
+import random
+import heapq
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
+from urllib.parse import urlparse
+
+governor_lock = threading.Lock()
+
+
+class WikipediaTransport:
+    """
+    Pooled HTTP transport for Wikipedia API requests
+
+    Keeps a keep-alive session per host, so that subsequent requests to the
+    same host re-use an open (TLS) connection rather than setting up a new
+    one every time. The number of simultaneous connections per host is
+    capped; requests beyond that cap wait for a connection to become free.
+
+    The transport also keeps some statistics about the requests sent through
+    it (see `RequestMetrics`), and optionally has a cache for responses that
+    never change. Traffic can also be recorded to, or replayed from, an
+    archive (see `TrafficArchive`).
+    """
+
+    user_agent = "4CAT-wikitools/1.0 (https://github.com/digitalmethodsinitiative/4cat-wikitools)"
+
+    def __init__(
+        self,
+        max_connections=4,
+        timeout=60,
+        cache=None,
+        governors=None,
+        retry_policy=None,
+        url_override=None,
+        archive=None,
+    ):
+        """
+        Set up transport
+
+        :param int max_connections:  Maximum number of simultaneous
+        connections per host
+        :param int timeout:  Default request timeout, in seconds
+        :param ResponseCache cache:  Cache for immutable responses, if any
+        :param dict governors:  Rate governors to use for `authenticated`
+        and `anonymous` requests
+        :param RetryPolicy retry_policy:  Policy for retrying failed
+        requests; by default, failed requests are not retried
+        :param str url_override:  Send all requests to this URL instead,
+        e.g. a local mock API for testing; the original host name is added
+        to the path, e.g. `https://en.wikipedia.org/w/api.php` becomes
+        `[url_override]/en.wikipedia.org/w/api.php`
+        :param TrafficArchive archive:  Archive to record responses to or, if
+        it was opened for replaying, to get responses from instead of
+        sending requests
+        """
+        self.max_connections = max(1, int(max_connections))
+        self.timeout = timeout
+        self.cache = cache
+        self.governors = governors or {}
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=0)
+        self.url_override = url_override.rstrip("/") if url_override else None
+        self.archive = archive
+        self.sessions = {}
+        self.stats = collections.Counter()
+        self.metrics = RequestMetrics()
+        self.lock = threading.Lock()
+
+    def get_session(self, host):
+        """
+        Get keep-alive session for a host
+
+        Sessions are created on first use.
+
+        :param str host:  Host name, e.g. `en.wikipedia.org`
+        :return requests.Session:  Session for that host
+        """
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.max_connections,
+                    pool_block=True,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(
+                    {
+                        "Accept-Encoding": "gzip, deflate",
+                        "User-Agent": self.user_agent,
+                    }
+                )
+                self.sessions[host] = session
+
+            return self.sessions[host]
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request through the session for the URL's host
+
+        If the transport replays an archive, the recorded response is
+        returned instead, and no request is sent.
+
+        :param str url:  URL to request
+        :param kwargs:  Keyword arguments are passed to `requests.Session.get`
+        :return requests.Response:  Response
+        """
+        if self.archive and self.archive.mode == "replay":
+            response = self.archive.replay(url, kwargs.get("params"))
+            if response is None:
+                raise ConnectionError(f"No response to request for {url} in archive")
+
+            return response
+
+        kwargs.setdefault("timeout", self.timeout)
+        parsed_url = urlparse(url)
+        request_url = url
+        if self.url_override:
+            request_url = f"{self.url_override}/{parsed_url.hostname}{parsed_url.path}"
+            if parsed_url.query:
+                request_url += f"?{parsed_url.query}"
+
+        response = self.get_session(parsed_url.hostname).get(request_url, **kwargs)
+        if self.archive:
+            self.archive.record(url, kwargs.get("params"), response)
+
+        return response
+
+    def get_governor(self, authenticated):
+        """
+        Get rate governor for a request
+
+        :param bool authenticated:  Whether the request is authenticated
+        :return RateGovernor:  Governor, or `None` if requests are not rate
+        limited
+        """
+        return self.governors.get("authenticated" if authenticated else "anonymous")
+
+    def count(self, statistic, amount=1):
+        """
+        Update request statistics
+
+        :param str statistic:  Statistic to update, e.g. `cache_hits`
+        :param int amount:  Amount to add
+        """
+        with self.lock:
+            self.stats[statistic] += amount
+
+    def close(self):
+        """
+        Close all open sessions and their connections
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+
+            self.sessions = {}
+
+        if self.archive:
+            self.archive.close()
+
+
+class RequestMetrics:
+    """
+    Timing and traffic statistics for Wikipedia API requests
+
+    Requests are aggregated per host, endpoint and action, so memory use
+    does not depend on the number of requests. For each, the number of
+    requests, response sizes, statuses, retries and cache use are counted,
+    and a histogram of latencies is kept. The time spent on requests is
+    split into time spent waiting for the network, waiting because of rate
+    limits or retries, and parsing responses. The slowest requests are
+    kept separately.
+    """
+
+    # upper bounds of latency histogram buckets, in seconds
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, num_slowest=10):
+        """
+        Set up metrics
+
+        :param int num_slowest:  Number of slowest requests to keep
+        """
+        self.num_slowest = num_slowest
+        self.endpoints = {}
+        self.slowest = []
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        host,
+        endpoint,
+        action,
+        latency,
+        size=0,
+        status=None,
+        retries=0,
+        cache=None,
+        waited=0,
+        parse_time=0,
+        params=None,
+    ):
+        """
+        Record a request
+
+        :param str host:  Host the request was sent to
+        :param str endpoint:  Endpoint (URL path) the request was sent to
+        :param str action:  API action, e.g. `parse` or `query/revisions`
+        :param float latency:  Time spent waiting for responses, in seconds,
+        for all attempts together
+        :param int size:  Size of the response body, in bytes
+        :param int status:  HTTP status of the (last) response, or `None` if
+        there was no response
+        :param int retries:  Number of times the request was retried
+        :param str cache:  `hit` or `miss` if the response cache was used
+        :param float waited:  Time spent waiting for rate limits and before
+        retries, in seconds
+        :param float parse_time:  Time spent parsing responses, in seconds
+        :param dict params:  Request parameters, to identify slow requests
+        """
+        bucket = len(self.latency_buckets)
+        for i, upper_bound in enumerate(self.latency_buckets):
+            if latency <= upper_bound:
+                bucket = i
+                break
+
+        with self.lock:
+            self.num_requests += 1
+            key = (host, endpoint, action)
+            if key not in self.endpoints:
+                self.endpoints[key] = {
+                    "requests": 0,
+                    "bytes": 0,
+                    "latency": 0,
+                    "max_latency": 0,
+                    "waited": 0,
+                    "parse_time": 0,
+                    "retries": 0,
+                    "statuses": collections.Counter(),
+                    "cache": collections.Counter(),
+                    "histogram": [0] * (len(self.latency_buckets) + 1),
+                }
+
+            metrics = self.endpoints[key]
+            metrics["requests"] += 1
+            metrics["bytes"] += size
+            metrics["latency"] += latency
+            metrics["max_latency"] = max(metrics["max_latency"], latency)
+            metrics["waited"] += waited
+            metrics["parse_time"] += parse_time
+            metrics["retries"] += retries
+            metrics["statuses"][str(status)] += 1
+            if cache:
+                metrics["cache"][cache] += 1
+            metrics["histogram"][bucket] += 1
+
+            # keep the slowest requests in a heap, fastest first
+            request = {
+                "host": host,
+                "endpoint": endpoint,
+                "action": action,
+                "latency": latency,
+                "status": status,
+                "retries": retries,
+                "params": {
+                    name: str(value)[:100] for name, value in (params or {}).items()
+                },
+            }
+            entry = (latency, self.num_requests, request)
+            if len(self.slowest) < self.num_slowest:
+                heapq.heappush(self.slowest, entry)
+            elif latency > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_summary(self):
+        """
+        Get summary of all recorded requests
+
+        :return dict:  Summary, with totals, metrics per endpoint (including
+        latency histograms) and the slowest requests
+        """
+        with self.lock:
+            endpoints = []
+            for (host, endpoint, action), metrics in self.endpoints.items():
+                endpoints.append(
+                    {
+                        "host": host,
+                        "endpoint": endpoint,
+                        "action": action,
+                        **metrics,
+                        "statuses": dict(metrics["statuses"]),
+                        "cache": dict(metrics["cache"]),
+                        "histogram": {
+                            **{
+                                f"<={upper_bound}s": count
+                                for upper_bound, count in zip(
+                                    self.latency_buckets, metrics["histogram"]
+                                )
+                            },
+                            f">{self.latency_buckets[-1]}s": metrics["histogram"][-1],
+                        },
+                    }
+                )
+
+            totals = {
+                field: sum([metrics[field] for metrics in endpoints])
+                for field in (
+                    "requests",
+                    "bytes",
+                    "latency",
+                    "waited",
+                    "parse_time",
+                    "retries",
+                )
+            }
+
+            return {
+                "totals": totals,
+                "endpoints": sorted(
+                    endpoints, key=lambda metrics: metrics["latency"], reverse=True
+                ),
+                "slowest": [
+                    request for _, _, request in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+
+class RateGovernor:
+    """
+    Token bucket rate limiter for Wikipedia API requests
+
+    Governors are shared between all processors in the same process (i.e.
+    all running 4CAT workers), so that together they stay within the API's
+    rate limits. There is one governor per budget, e.g. one for requests
+    with and one for requests without an API key; get it with
+    `get_governor()`.
+
+    When the API signals that requests should slow down (a 429 status, or a
+    `maxlag` error), requests are paused for the time the API asks for and
+    the request rate is halved. After that it is gradually increased again
+    as requests succeed, up to the configured rate.
+    """
+
+    governors = {}
+
+    def __init__(self, rate):
+        """
+        Set up governor
+
+        :param float rate:  Maximum sustained requests per second
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_governor(cls, budget, rate):
+        """
+        Get shared governor for a budget
+
+        :param str budget:  Budget name, e.g. `anonymous`
+        :param float rate:  Maximum sustained requests per second; if the
+        governor already exists, its rate is updated
+        :return RateGovernor:  Governor
+        """
+        rate = max(0.01, float(rate))
+        with governor_lock:
+            if budget not in cls.governors:
+                cls.governors[budget] = cls(rate)
+
+            governor = cls.governors[budget]
+
+        with governor.lock:
+            if governor.max_rate != rate:
+                governor.max_rate = rate
+                governor.rate = min(governor.rate, rate)
+
+        return governor
+
+    def wait(self):
+        """
+        Wait until a request may be sent
+
+        :return float:  Time waited, in seconds
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # allow bursts of up to a second's worth of requests
+                self.tokens = min(
+                    max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+    def slow_down(self, retry_after=None):
+        """
+        Slow down after the API signalled too many requests are being made
+
+        :param float retry_after:  Seconds to pause all requests for, if the
+        API indicated this
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(
+                self.paused_until, now + (retry_after or 1 / self.rate)
+            )
+
+    def speed_up(self):
+        """
+        Gradually return to the maximum rate after a successful request
+        """
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RetryPolicy:
+    """
+    Policy for retrying failed Wikipedia API requests
+
+    Failures that are likely to be temporary (server errors, time-outs,
+    dropped connections) are retried with exponential backoff, with some
+    random jitter so that parallel requests do not all retry at the same
+    moment. Other failures (e.g. a 404, or an invalid request) are not
+    retried.
+    """
+
+    # exceptions that indicate a temporary network problem
+    retryable_exceptions = (ConnectionError, Timeout, ChunkedEncodingError)
+
+    # API error codes that indicate a temporary problem on Wikipedia's end
+    retryable_errors = ("readonly", "internal_api_error", "backend-fail")
+
+    def __init__(self, max_retries=5, backoff=1, max_backoff=60):
+        """
+        Set up policy
+
+        :param int max_retries:  Maximum number of retries per request
+        :param float backoff:  Delay before the first retry, in seconds;
+        doubled for every subsequent retry
+        :param float max_backoff:  Maximum delay between retries, in seconds
+        """
+        self.max_retries = max(0, int(max_retries))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_retryable(self, result=None, result_json=None, exception=None):
+        """
+        Determine whether a failed request should be retried
+
+        :param requests.Response result:  API response, if any
+        :param dict result_json:  Parsed API response, if any
+        :param Exception exception:  Exception raised while sending the
+        request or reading the response, if any
+        :return bool:  Whether the request should be retried
+        """
+        if exception is not None:
+            # a 200 response that cannot be parsed was probably cut off
+            return isinstance(exception, self.retryable_exceptions) or (
+                isinstance(exception, ValueError)
+                and result is not None
+                and result.status_code == 200
+            )
+
+        if result is not None and result.status_code >= 500:
+            return True
+
+        if not isinstance(result_json, dict):
+            return False
+
+        error = result_json.get("error", {}).get("code", "")
+        return any([error.startswith(code) for code in self.retryable_errors])
+
+    def get_delay(self, retry):
+        """
+        Get time to wait before retrying
+
+        :param int retry:  Number of the retry, starting at 1
+        :return float:  Delay, in seconds
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** (retry - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
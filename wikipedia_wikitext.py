@@ -0,0 +1,122 @@
+"""
+Local helpers for working with Wikipedia wikitext
+"""
+
+import re
+
+# parts of the wikitext in which headings are not headings; an unterminated
+# comment runs to the end of the page, but an unclosed tag is just text
+IGNORED_MARKUP = re.compile(
+    r"<!--.*?(?:-->|$)"
+    r"|<(nowiki|pre|syntaxhighlight|source)(?:\s[^>]*)?>.*?</\1\s*>"
+    r"|<nowiki\s*/>",
+    re.DOTALL | re.IGNORECASE,
+)
+
+HEADING = re.compile(r"^(={1,6})(.+?)(={1,6})[ \t]*$", re.MULTILINE)
+
+# inline markup, removed or simplified to get a heading's text
+TEMPLATE = re.compile(r"\{\{[^{}]*\}\}")
+INTERNAL_LINK = re.compile(r"\[\[(?:[^\[\]|]*\|)?([^\[\]]*)\]\]")
+EXTERNAL_LINK = re.compile(r"\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]")
+FORMATTING = re.compile(r"'{2,}|<[^>]+>")
+
+
+def get_heading_text(heading):
+    """
+    Get plain text for a heading
+
+    This is a simplified version of what the MediaWiki parser does: links are
+    replaced with their label, templates, HTML tags and bold/italic markup
+    are removed.
+
+    :param str heading:  Heading wikitext, without the surrounding `=`s
+    :return str:  Heading text
+    """
+    previous = None
+    while previous != heading:
+        # templates may be nested, so remove them inside-out
+        previous = heading
+        heading = TEMPLATE.sub("", heading)
+
+    heading = INTERNAL_LINK.sub(r"\1", heading)
+    heading = EXTERNAL_LINK.sub(r"\1", heading)
+    heading = FORMATTING.sub("", heading)
+
+    return " ".join(heading.split())
+
+
+def get_wikitext_sections(wikitext, title=""):
+    """
+    Get table of contents for a piece of wikitext
+
+    Extracts headings from the wikitext and returns them in the same format
+    as the `sections` returned by the `action=parse` API endpoint. Headings
+    in comments, `<nowiki>` and `<pre>` blocks are ignored. Headings that are
+    generated by templates cannot be detected this way; this is why this is
+    an approximation of the actual table of contents.
+
+    :param str wikitext:  Wikitext of the page
+    :param str title:  Page title, used as `fromtitle`
+    :return list:  List of section dictionaries, with `toclevel`, `level`,
+    `line`, `number`, `index`, `fromtitle` and `anchor` keys
+    """
+    wikitext = IGNORED_MARKUP.sub("", wikitext)
+
+    sections = []
+    anchors = {}
+    toclevel = 0
+    previous_level = 0
+    level_at_toclevel = {}
+    sublevel_count = {}
+
+    for heading in HEADING.finditer(wikitext):
+        left, text, right = heading.groups()
+        level = min(len(left), len(right))
+        text = "=" * (len(left) - level) + text + "=" * (len(right) - level)
+        line = get_heading_text(text)
+
+        # determine nesting the same way MediaWiki's parser does, i.e.
+        # relative to the headings before it rather than by absolute level
+        if level > previous_level:
+            toclevel += 1
+            sublevel_count[toclevel] = 0
+        elif level < previous_level and toclevel > 1:
+            for i in range(toclevel, 0, -1):
+                if level_at_toclevel[i] == level:
+                    toclevel = i
+                    break
+                elif level_at_toclevel[i] < level:
+                    toclevel = i + 1
+                    break
+            else:
+                toclevel = 1
+
+        level_at_toclevel[toclevel] = level
+        sublevel_count[toclevel] = sublevel_count.get(toclevel, 0) + 1
+        for deeper in [i for i in sublevel_count if i > toclevel]:
+            del sublevel_count[deeper]
+        previous_level = level
+
+        anchor = line.replace(" ", "_")
+        if anchor in anchors:
+            anchors[anchor] += 1
+            anchor = f"{anchor}_{anchors[anchor]}"
+        else:
+            anchors[anchor] = 1
+
+        sections.append(
+            {
+                "toclevel": toclevel,
+                "level": str(level),
+                "line": line,
+                "number": ".".join(
+                    [str(sublevel_count[i]) for i in range(1, toclevel + 1)]
+                ),
+                "index": str(len(sections) + 1),
+                "fromtitle": title,
+                "anchor": anchor,
+            }
+        )
+
+    return sections